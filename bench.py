@@ -0,0 +1,1146 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# CommentRelayのベンチマーク
+# ワンコメ・Minecraft(RCON)・Discordの代わりにローカルの偽サーバーを立てて計測する
+# 使い方: python bench.py rcon --comments 500
+#         python bench.py discord --comments 100 --rate 20
+#         python bench.py expiry --ids 1000000
+#         python bench.py memory --comments 1000000
+#         python bench.py reward --fail-rate 0.3
+#         python bench.py render --comments 100000
+#         python bench.py --json result.json e2e --duration 20 --rate 5
+#         python bench.py startup --webhook-latency 3
+#         python bench.py routing --sources 3 --servers 4
+#         python bench.py catchup --backlog 100 --rate 10
+#         python bench.py ingest --comments 10000 100000
+#         python bench.py isolation --wedge-at 5 --timeout 3
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_CONFIG = {
+    'discord_webhook_url': 'http://127.0.0.1:9/webhook',
+    'api_endpoint': 'http://127.0.0.1:9/api/comments',
+    'polling_interval': 1,
+    'comment_expiry_days': 1,
+    'minecraft_rcon_host': '127.0.0.1',
+    'minecraft_rcon_port': 25575,
+    'minecraft_rcon_password': 'bench',
+    'custom_format': '<{display_name}>:{message}',
+    'message_color': 'yellow',
+    'api_key': 'bench',
+    'log_level': 'WARNING',
+}
+
+# リレー側の大量のprintを計測結果に混ぜないためのもの
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+# 一時ディレクトリにconfig.jsonを用意する
+# （本番の設定ファイルや処理済みコメントを汚さないため）
+def make_workdir(**overrides):
+    workdir = tempfile.mkdtemp(prefix='commentrelay-bench-')
+    config = dict(BENCH_CONFIG, **overrides)
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as file:
+        json.dump(config, file, ensure_ascii=False, indent=4)
+    return workdir
+
+# 一時ディレクトリに移動してからscript.pyを読み込む
+def import_relay(**overrides):
+    os.chdir(make_workdir(**overrides))
+    if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+    import script
+    return script
+
+
+# 偽RCONサーバー（ログインとコマンドに応答するだけ）
+def recv_exact(sock, length):
+    data = b''
+    while len(data) < length:
+        try:
+            chunk = sock.recv(length - len(data))
+        except OSError:
+            return None
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def rcon_packet(request_id, packet_type, payload):
+    body = struct.pack('<ii', request_id, packet_type) + payload.encode('utf8') + b'\x00\x00'
+    return struct.pack('<i', len(body)) + body
+
+class FakeRconHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            header = recv_exact(self.request, 4)
+            if header is None:
+                return
+            (length,) = struct.unpack('<i', header)
+            body = recv_exact(self.request, length)
+            if body is None:
+                return
+            request_id, packet_type = struct.unpack('<ii', body[:8])
+            payload = body[8:-2].decode('utf8')
+            if packet_type == 3:
+                time.sleep(server.login_latency)
+                with server.lock:
+                    server.logins += 1
+                ok = payload == server.password
+                self.request.sendall(rcon_packet(request_id if ok else -1, 2, ''))
+            else:
+                with server.lock:
+                    wedge, server.wedge_next = server.wedge_next, 0
+                if wedge:
+                    self.drip(rcon_packet(request_id, 0, 'x' * 1000), wedge)
+                    return
+                time.sleep(server.command_latency)
+                with server.lock:
+                    server.commands.append((time.perf_counter(), payload))
+                self.request.sendall(rcon_packet(request_id, 0, ''))
+
+    # 返事を1バイトずつゆっくり返す。ソケットのタイムアウトでは気づけない止まり方（半分切れた接続など）をまねる
+    def drip(self, data, seconds):
+        end = time.perf_counter() + seconds
+        for byte in data:
+            if time.perf_counter() >= end:
+                return
+            try:
+                self.request.sendall(bytes([byte]))
+            except OSError:
+                return
+            time.sleep(0.5)
+
+class FakeRconServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password='bench', login_latency=0.0, command_latency=0.0):
+        super().__init__(('127.0.0.1', 0), FakeRconHandler)
+        self.password = password
+        self.login_latency = login_latency
+        self.command_latency = command_latency
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.commands = []
+        self.wedge_next = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    # 次に届いたコマンドの接続をseconds秒のあいだ止める（それ以外の接続は普通に応答する）
+    def wedge(self, seconds):
+        with self.lock:
+            self.wedge_next = seconds
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# 偽Discord Webhook（Discordと同じようにレート制限をかける）
+class FakeDiscordHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.server.check_latency)
+        self.send_json(200, {'type': 1, 'id': 'bench'})
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        received = time.perf_counter()
+        with server.lock:
+            now = time.monotonic()
+            if now >= server.window_reset:
+                server.window_reset = now + server.window
+                server.remaining = server.limit
+            reset_after = server.window_reset - now
+            if server.remaining <= 0:
+                server.rate_limited += 1
+                status = 429
+            else:
+                server.remaining -= 1
+                server.messages.append((received, payload))
+                status = 200
+            headers = {
+                'X-RateLimit-Limit': str(server.limit),
+                'X-RateLimit-Remaining': str(max(server.remaining, 0)),
+                'X-RateLimit-Reset-After': f'{reset_after:.3f}',
+            }
+        time.sleep(server.latency)
+        if status == 429:
+            self.send_json(429, {'message': 'You are being rate limited.', 'retry_after': round(reset_after, 3), 'global': False}, headers)
+        else:
+            self.send_json(200, {'id': str(len(server.messages))}, headers)
+
+class FakeDiscordServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # 既定値はDiscordのWebhookと同じく2秒ごとに5回まで
+    def __init__(self, limit=5, window=2.0, latency=0.0, check_latency=0.0):
+        super().__init__(('127.0.0.1', 0), FakeDiscordHandler)
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.check_latency = check_latency  # Webhookの確認(GET)に答えるまでの時間
+        self.lock = threading.Lock()
+        self.remaining = limit
+        self.window_reset = 0.0
+        self.rate_limited = 0
+        self.messages = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/webhook'
+
+    # 受け取ったメッセージを1コメントずつに分解する
+    def comments(self):
+        result = []
+        for received, payload in self.messages:
+            if 'embeds' in payload:
+                result.extend((received, embed['description']) for embed in payload['embeds'])
+            else:
+                result.append((received, payload['content']))
+        return result
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# 偽報酬API（失敗をわざと混ぜられる）
+class FakeRewardHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        from urllib.parse import parse_qs
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with server.lock:
+            if time.monotonic() < server.down_until or server.random.random() < server.fail_rate:
+                server.failures += 1
+                status = 503
+            else:
+                server.received.append((form['user_id'][0], form['live_id'][0]))
+                status = 200
+        body = b'ok' if status == 200 else b'unavailable'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeRewardServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fail_rate=0.0, down_seconds=0.0, seed=0):
+        import random
+        super().__init__(('127.0.0.1', 0), FakeRewardHandler)
+        self.random = random.Random(seed)
+        self.fail_rate = fail_rate
+        self.down_until = time.monotonic() + down_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.received = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/API/save_reward.php'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# 偽ワンコメ（/api/commentsで直近のコメント一覧を返す）
+# コメントは一定の速さで増え、burst_everyごとにburst_size件がまとめて届く
+class FakeOneCommeHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            comments = server.comments[-server.window:]
+            body = json.dumps(comments, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeOneCommeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # nameはコメントIDと本文に入れる名前（複数の配信を区別するため、数字で終わらないものにする）
+    def __init__(self, rate=5.0, burst_size=0, burst_every=0.0, window=200, users=100, seed=0, name='bench'):
+        import random
+        super().__init__(('127.0.0.1', 0), FakeOneCommeHandler)
+        self.random = random.Random(seed)
+        self.name = name
+        self.rate = rate
+        self.burst_size = burst_size
+        self.burst_every = burst_every
+        self.window = window
+        self.users = users
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.comments = []
+        self.created = {}  # コメント番号 -> 作られた時刻(perf_counter)
+        self.stopped = threading.Event()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/api/comments'
+
+    # ageを指定すると、その秒数だけ前に投稿されていたコメントにする（停止中に溜まっていた分）
+    def add_comment(self, text=None, age=0.0):
+        from datetime import datetime, timedelta, timezone
+        with self.lock:
+            number = len(self.comments)
+            user = self.random.randrange(self.users)
+            self.comments.append({
+                'service': 'youtube',
+                'data': {
+                    'id': f'{self.name}-comment-{number}',
+                    'liveId': f'{self.name}-live',
+                    'userId': f'bench-user-{user}',
+                    'displayName': f'視聴者{user}',
+                    'comment': text or f'コメント {self.name}{number}',
+                    'timestamp': (datetime.now(timezone.utc) - timedelta(seconds=age)).isoformat(),
+                    'originalProfileImage': '',
+                },
+            })
+            self.created[number] = time.perf_counter()
+
+    # durationの間コメントを作り続ける
+    def generate(self, duration):
+        start = time.perf_counter()
+        next_comment = start
+        next_burst = start + self.burst_every if self.burst_every else None
+        while not self.stopped.is_set():
+            now = time.perf_counter()
+            if now - start >= duration:
+                return
+            if next_burst is not None and now >= next_burst:
+                for _ in range(self.burst_size):
+                    self.add_comment()
+                next_burst += self.burst_every
+            if self.rate and now >= next_comment:
+                self.add_comment()
+                next_comment += 1 / self.rate
+            time.sleep(0.001)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# RCON: コメントごとに接続する場合と接続プールを使う場合の比較
+def bench_rcon(args):
+    from mcrcon import MCRcon
+
+    server = FakeRconServer(login_latency=args.login_latency, command_latency=args.command_latency).start()
+    import_relay(minecraft_rcon_port=server.port)
+    from senders import RconPool
+    command = 'tellraw @a {"text":"<bench>:hello","color":"yellow"}'
+    results = {}
+
+    server.logins = 0
+    start = time.perf_counter()
+    for _ in range(args.comments):
+        with MCRcon('127.0.0.1', 'bench', port=server.port) as mcr:
+            mcr.command(command)
+    elapsed = time.perf_counter() - start
+    results['per_comment_connect'] = {'comments_per_sec': args.comments / elapsed, 'logins': server.logins}
+
+    server.logins = 0
+    pool = RconPool()
+    start = time.perf_counter()
+    for _ in range(args.comments):
+        pool.command('127.0.0.1', server.port, 'bench', command)
+    elapsed = time.perf_counter() - start
+    pool.close()
+    results['pooled'] = {'comments_per_sec': args.comments / elapsed, 'logins': server.logins}
+
+    server.shutdown()
+    return results
+
+
+# Discord: 1件ずつ送る従来の方法と、レート制限に合わせてまとめて送る方法の比較
+def bench_discord(args):
+    import requests
+
+    baseline_server = FakeDiscordServer(limit=args.limit, window=args.window).start()
+    server = FakeDiscordServer(limit=args.limit, window=args.window).start()
+    script = import_relay(discord_webhook_url=server.url)
+    results = {}
+
+    # 従来の方法: コメントごとにrequests.postし、エラーになったら諦める
+    start = time.perf_counter()
+    for i in range(args.comments):
+        requests.post(baseline_server.url, json={'username': 'bench', 'content': f'comment {i}'})
+        time.sleep(1 / args.rate)
+    elapsed = time.perf_counter() - start
+    results['per_comment_post'] = {
+        'delivered': len(baseline_server.comments()),
+        'webhook_calls': len(baseline_server.messages),
+        'rate_limited': baseline_server.rate_limited,
+        'seconds': elapsed,
+    }
+
+    worker = script.SinkWorker('Discord', script.send_discord_batch, max_batch=script.DISCORD_MAX_EMBEDS,
+                               wait=script.discord_sender.wait_for_bucket, batch_limit=script.discord_sender.batch_limit)
+    with quiet():
+        worker.start()
+        start = time.perf_counter()
+        for i in range(args.comments):
+            worker.put(('bench', f'comment {i}', ''))
+            time.sleep(1 / args.rate)
+        worker.queue.join()
+        elapsed = time.perf_counter() - start
+        worker.stop()
+    delivered = [text for _, text in server.comments()]
+    results['batched_sender'] = {
+        'delivered': len(delivered),
+        'in_order': delivered == [f'comment {i}' for i in range(args.comments)],
+        'webhook_calls': len(server.messages),
+        'rate_limited': server.rate_limited,
+        'seconds': elapsed,
+    }
+
+    baseline_server.shutdown()
+    server.shutdown()
+    return results
+
+
+# 期限切れ削除: 全件を走査する従来の方法と、古い順のキューを使う方法の1ポーリングあたりの時間
+def bench_expiry(args):
+    from datetime import datetime, timedelta, timezone
+
+    script = import_relay()
+    now = time.time()
+    # 1件/ミリ秒の間隔で処理した想定で、最後の数件だけが期限切れになるようにする
+    timestamps = [now - args.ids / 1000 + i / 1000 for i in range(args.ids)]
+    expiry_time = timestamps[args.expired_per_poll]
+    results = {}
+
+    legacy = {f'id{i}': [datetime.fromtimestamp(ts, timezone.utc).isoformat(), 'live'] for i, ts in enumerate(timestamps)}
+    expiry = datetime.fromtimestamp(expiry_time, timezone.utc)
+    start = time.perf_counter()
+    for _ in range(args.polls):
+        expired_keys = [key for key, (timestamp, live_id) in legacy.items()
+                        if datetime.fromisoformat(timestamp) < expiry]
+        for key in expired_keys:
+            del legacy[key]
+    results['full_scan'] = {'ms_per_poll': (time.perf_counter() - start) * 1000 / args.polls, 'ids': args.ids}
+    del legacy
+
+    store = script.ProcessedCommentStore(':memory:')
+    for i, ts in enumerate(timestamps):
+        store.add(f'id{i}', ts, 'live')
+    store.pending_adds.clear()
+    start = time.perf_counter()
+    for poll in range(args.polls):
+        store.expire(timestamps[(poll + 1) * args.expired_per_poll])
+    results['ordered_index'] = {'ms_per_poll': (time.perf_counter() - start) * 1000 / args.polls, 'ids': args.ids}
+    return results
+
+
+# メモリ: 従来の辞書+setと、コンパクトな保存方法で同じ数のコメントを保持したときの使用量
+def bench_memory(args):
+    import random
+    import tracemalloc
+    from datetime import datetime, timezone
+
+    script = import_relay()
+    now = time.time()
+    # 配信枠ごとに同じ視聴者が何度もコメントする想定
+    comments = [
+        (f'LPeRcomment{i:032d}', now + i / 1000, f'live{i % args.lives:04d}', f'yt-user{random.randrange(args.users):08d}')
+        for i in range(args.comments)
+    ]
+    results = {}
+
+    tracemalloc.start()
+    processed = {}
+    tracker = {}
+    for comment_id, timestamp, live_id, user_id in comments:
+        # APIから受け取るたびに別の文字列オブジェクトになるのでコピーしておく
+        live_id = ''.join(live_id)
+        user_id = ''.join(user_id)
+        processed[comment_id] = [datetime.fromtimestamp(timestamp, timezone.utc).isoformat(), live_id]
+        tracker.setdefault(live_id, set()).add(user_id)
+    results['dict_and_sets'] = {'mb': tracemalloc.get_traced_memory()[0] / 1e6, 'comments': args.comments}
+    tracemalloc.stop()
+    del processed, tracker
+
+    tracemalloc.start()
+    store = script.ProcessedCommentStore(':memory:')
+    tracker = script.LiveCommentTracker()
+    for comment_id, timestamp, live_id, user_id in comments:
+        live_id = ''.join(live_id)
+        user_id = ''.join(user_id)
+        store.append(comment_id, timestamp, live_id)
+        if tracker.is_first_time(live_id, user_id, timestamp):
+            tracker.add(live_id, user_id)
+    results['compact_store'] = {'mb': tracemalloc.get_traced_memory()[0] / 1e6, 'comments': args.comments}
+    tracemalloc.stop()
+    return results
+
+
+# 整形: 送信先ごとに<img>の除去とフォーマットをやり直す従来の方法と、
+# 1回の後始末から両方の送信先の形を作る方法の、コメント1件あたりの時間
+def bench_render(args):
+    import random
+    import re
+
+    script = import_relay()
+    rng = random.Random(0)
+    emoji = [f'<img src="https://yt3.ggpht.com/emoji{i}=w24-h24-c-k-nd" alt=":_emoji{i}:" class="emoji">' for i in range(30)]
+    comments = []
+    for i in range(args.comments):
+        words = [f'こんにちは{i}', 'すごい', 'ｗｗｗ']
+        for _ in range(rng.randrange(3) if rng.random() < args.emoji_rate else 0):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(emoji))
+        comments.append((f'user{i % 500}', ' '.join(words), '2024-01-01T00:00:00.000Z', 'https://yt3.ggpht.com/avatar'))
+    results = {}
+
+    def remove_img_tags(text):
+        img_tag_pattern = r'<img src=".*?" alt=".*?"\s*/?>'
+        return re.sub(img_tag_pattern, '', text)
+
+    config = script.config
+    start = time.perf_counter()
+    for display_name, text, timestamp, avatar_url in comments:
+        remove_img_tags(text)
+        text_cleaned = remove_img_tags(text)
+        custom_format = config.get('custom_format', "<{display_name}>: {message}")
+        color = config.get('message_color', 'yellow')
+        try:
+            final_message = custom_format.format(display_name=display_name, message=text_cleaned, timestamp=timestamp, color=color)
+        except (KeyError, ValueError):
+            final_message = f"<{display_name}> {text_cleaned} ({color})"
+    elapsed = time.perf_counter() - start
+    results['per_sink'] = {'us_per_comment': elapsed * 1e6 / args.comments, 'comments': args.comments}
+
+    script.tag_fallbacks.clear()
+    start = time.perf_counter()
+    for comment in comments:
+        cleaned = script.clean_comment(*comment)
+        script.discord_message(cleaned)
+        script.minecraft_message(cleaned)
+    elapsed = time.perf_counter() - start
+    results['shared_pass'] = {'us_per_comment': elapsed * 1e6 / args.comments, 'comments': args.comments,
+                              'cached_tags': len(script.tag_fallbacks)}
+    return results
+
+
+# 報酬API: 障害と途中での再起動があっても全件届くか
+def bench_reward(args):
+    server = FakeRewardServer(fail_rate=args.fail_rate, down_seconds=args.down_seconds).start()
+    script = import_relay()
+    script.REWARD_API_URL = server.url
+    expected = [(f'user{i}', 'live') for i in range(args.rewards)]
+
+    def open_outbox():
+        outbox = script.RewardOutbox('bench_outbox.db')
+        outbox.retry_base_delay = 0.05
+        outbox.retry_max_delay = 0.5
+        outbox.start()
+        return outbox
+
+    start = time.perf_counter()
+    with quiet():
+        outbox = open_outbox()
+        for i, (user_id, live_id) in enumerate(expected):
+            if i == args.rewards // 2:
+                # 送信途中で再起動した場合
+                outbox.stop()
+                outbox.close()
+                outbox = open_outbox()
+            outbox.put(user_id, live_id)
+        deadline = time.monotonic() + args.timeout
+        while outbox.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        outbox.stop()
+        outbox.close()
+    elapsed = time.perf_counter() - start
+
+    received = set(server.received)
+    server.shutdown()
+    return {
+        'rewards': args.rewards,
+        'delivered': len(received & set(expected)),
+        'lost': len(set(expected) - received),
+        'duplicates': len(server.received) - len(received),
+        'injected_failures': server.failures,
+        'seconds': elapsed,
+    }
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    def pick(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        'count': len(values),
+        'p50_ms': pick(50) * 1000,
+        'p90_ms': pick(90) * 1000,
+        'p99_ms': pick(99) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+# 送信先に届いた文字列からコメント番号を取り出し、作られてから届くまでの時間を求める
+def delivery_latencies(created, deliveries, name='bench'):
+    import re
+    latencies = {}
+    for received, text in deliveries:
+        for number in re.findall(re.escape(name) + r'(\d+)', text):
+            number = int(number)
+            if number in created and number not in latencies:
+                latencies[number] = received - created[number]
+    return list(latencies.values())
+
+# 計測した版が分かるようにgitのコミットを記録する
+def git_revision():
+    import subprocess
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# リレーの計測値から送信先ごとの破棄件数を合計する
+def dropped_count(script, sink):
+    return sum(value for (name, labels), value in script.metrics.counters.items()
+               if name == 'commentrelay_dropped_total' and ('sink', sink) in labels)
+
+# 送信先ごとに、送信処理の中で使ったCPU時間を測るためのラッパー
+def cpu_timed(function, totals, name):
+    def wrapper(*args):
+        start = time.thread_time()
+        try:
+            return function(*args)
+        finally:
+            totals[name] = totals.get(name, 0.0) + time.thread_time() - start
+    return wrapper
+
+# エンドツーエンド: 偽ワンコメ・偽RCON・偽Discord・偽報酬APIを相手にscript.pyのリレーを動かす
+def bench_e2e(args):
+    import _thread
+
+    onecomme = FakeOneCommeServer(rate=args.rate, burst_size=args.burst_size, burst_every=args.burst_every,
+                                  window=args.window, users=args.users).start()
+    rcon = FakeRconServer(command_latency=args.rcon_latency).start()
+    discord = FakeDiscordServer(limit=args.discord_limit, window=args.discord_window).start()
+    reward = FakeRewardServer().start()
+    script = import_relay(
+        api_endpoint=onecomme.url,
+        discord_webhook_url=discord.url,
+        minecraft_rcon_port=rcon.port,
+        polling_interval=args.interval,
+        use_comment_stream=False,
+    )
+    script.REWARD_API_URL = reward.url
+
+    cpu = {}
+    script.send_discord_batch = cpu_timed(script.send_discord_batch, cpu, 'discord')
+    script.send_minecraft_batch = cpu_timed(script.send_minecraft_batch, cpu, 'minecraft')
+    script.fetch_comments = cpu_timed(script.fetch_comments, cpu, 'fetch')
+
+    # コメントを作り終えて送信が落ち着くまで待ってからリレーを止める
+    def drive():
+        onecomme.generate(args.duration)
+        time.sleep(args.drain)
+        _thread.interrupt_main()
+    threading.Thread(target=drive, daemon=True).start()
+
+    usage_before = process_usage()
+    start = time.perf_counter()
+    with quiet():
+        try:
+            script.poll_comments()
+        except KeyboardInterrupt:
+            pass
+    elapsed = time.perf_counter() - start
+    usage_after = process_usage()
+
+    created = onecomme.created
+    discord_latencies = delivery_latencies(created, discord.comments())
+    minecraft_latencies = delivery_latencies(created, [(received, payload) for received, payload in rcon.commands])
+    results = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'params': {key: value for key, value in vars(args).items() if key != 'func'},
+        'generated': len(created),
+        'polls': onecomme.requests,
+        'seconds': elapsed,
+        'sinks': {
+            'discord': dict(percentiles(discord_latencies),
+                            throughput_per_sec=len(discord_latencies) / elapsed,
+                            webhook_calls=len(discord.messages),
+                            rate_limited=discord.rate_limited,
+                            dropped=dropped_count(script, 'discord'),
+                            cpu_seconds=cpu.get('discord', 0.0)),
+            'minecraft': dict(percentiles(minecraft_latencies),
+                              throughput_per_sec=len(minecraft_latencies) / elapsed,
+                              rcon_commands=len(rcon.commands),
+                              rcon_logins=rcon.logins,
+                              dropped=dropped_count(script, 'minecraft'),
+                              cpu_seconds=cpu.get('minecraft', 0.0)),
+            'reward': {'count': len(reward.received)},
+        },
+        'fetch_cpu_seconds': cpu.get('fetch', 0.0),
+        'process': {
+            'cpu_seconds': usage_after['cpu_seconds'] - usage_before['cpu_seconds'],
+            'max_rss_mb': usage_after['max_rss_mb'],
+        },
+    }
+    onecomme.shutdown()
+    rcon.shutdown()
+    discord.shutdown()
+    reward.shutdown()
+    return results
+
+# 複数の配信・複数のサーバー: 1つのプロセスで全ての配信をポーリングし、経路どおりに届くか
+# 配信ごとに専用のDiscord、全ての配信を全てのMinecraftサーバー（Velocityのネットワークを想定）に送る
+def bench_routing(args):
+    import _thread
+
+    names = [f'stream{chr(ord("a") + i)}' for i in range(args.sources)]
+    streams = [FakeOneCommeServer(rate=args.rate, seed=i, name=name).start() for i, name in enumerate(names)]
+    discords = [FakeDiscordServer().start() for _ in names]
+    servers = [FakeRconServer().start() for _ in range(args.servers)]
+    reward = FakeRewardServer().start()
+    script = import_relay(
+        polling_interval=args.interval,
+        use_comment_stream=False,
+        sources=[{'name': name, 'api_endpoint': stream.url} for name, stream in zip(names, streams)],
+        sinks=[{'name': f'discord-{name}', 'type': 'discord', 'webhook_url': discord.url} for name, discord in zip(names, discords)]
+              + [{'name': f'server{i}', 'type': 'minecraft', 'host': '127.0.0.1', 'port': server.port, 'password': 'bench'}
+                 for i, server in enumerate(servers)],
+        routes=[{'source': name, 'sinks': [f'discord-{name}'] + [f'server{i}' for i in range(args.servers)]} for name in names],
+    )
+    script.REWARD_API_URL = reward.url
+
+    def drive():
+        generators = [threading.Thread(target=stream.generate, args=(args.duration,)) for stream in streams]
+        for generator in generators:
+            generator.start()
+        for generator in generators:
+            generator.join()
+        time.sleep(args.drain)
+        _thread.interrupt_main()
+    threading.Thread(target=drive, daemon=True).start()
+
+    with quiet():
+        try:
+            script.poll_comments()
+        except KeyboardInterrupt:
+            pass
+
+    results = {'sources': {}, 'sinks': {}}
+    for name, stream, discord in zip(names, streams, discords):
+        delivered = delivery_latencies(stream.created, discord.comments(), name)
+        misrouted = sum(1 for _, text in discord.comments() if any(other in text for other in names if other != name))
+        results['sources'][name] = {'generated': len(stream.created), 'polls': stream.requests}
+        results['sinks'][f'discord-{name}'] = dict(percentiles(delivered), misrouted=misrouted)
+    for i, server in enumerate(servers):
+        results['sinks'][f'server{i}'] = {
+            name: percentiles(delivery_latencies(stream.created, server.commands, name)) for name, stream in zip(names, streams)
+        }
+        results['sinks'][f'server{i}']['rcon_logins'] = server.logins
+    for server in streams + discords + servers + [reward]:
+        server.shutdown()
+    return results
+
+# 1秒間にMinecraftのチャットに流れたコメント数の最大
+def max_lines_per_second(commands, name='bench'):
+    import re
+    times = sorted(received for received, payload in commands for _ in re.findall(re.escape(name) + r'\d+', payload))
+    most = 0
+    first = 0
+    for last, received in enumerate(times):
+        while received - times[first] > 1.0:
+            first += 1
+        most = max(most, last - first + 1)
+    return most
+
+# 溜まっていたコメント: 再起動の直後に、停止中に溜まっていたコメントを一度に流す方法（catchup_rate=0）と、
+# 決まった速さで送る方法・件数だけにまとめる方法で、チャットの埋まり方とレート制限、新しいコメントの遅れを比べる
+def bench_catchup(args):
+    import _thread
+
+    script = import_relay(polling_interval=args.interval, use_comment_stream=False)
+    results = {}
+    for mode, rate, summary in (('burst', 0, False), ('paced', args.rate, False), ('summary', args.rate, True)):
+        onecomme = FakeOneCommeServer(rate=args.live_rate, window=args.backlog + 1000).start()
+        for _ in range(args.backlog):
+            onecomme.add_comment(age=args.backlog_age)
+        rcon = FakeRconServer().start()
+        discord = FakeDiscordServer().start()
+        reward = FakeRewardServer().start()
+
+        # 同じプロセスで続けて動かすので、前の回の状態を作り直す
+        script.config.update(api_endpoint=onecomme.url, discord_webhook_url=discord.url, minecraft_rcon_port=rcon.port)
+        script.processed_comments = script.ProcessedCommentStore(':memory:')
+        script.live_comments_tracker = script.LiveCommentTracker()
+        script.reward_outbox = script.RewardOutbox(':memory:')
+        script.REWARD_API_URL = reward.url
+        script.CATCHUP_RATE = script.catchup_pacer.rate = rate
+        script.CATCHUP_SUMMARY = summary
+        dropped_before = dropped_count(script, 'discord') + dropped_count(script, 'minecraft')
+
+        def drive():
+            onecomme.generate(args.duration)
+            time.sleep(args.drain)
+            _thread.interrupt_main()
+        threading.Thread(target=drive, daemon=True).start()
+        with quiet():
+            try:
+                script.poll_comments()
+            except KeyboardInterrupt:
+                pass
+
+        live = {number: created for number, created in onecomme.created.items() if number >= args.backlog}
+        backlog = {number: created for number, created in onecomme.created.items() if number < args.backlog}
+        results[mode] = {
+            'catchup_rate': rate,
+            'catchup_summary': summary,
+            'backlog_delivered': len(delivery_latencies(backlog, rcon.commands)),
+            'live': percentiles(delivery_latencies(live, rcon.commands)),
+            'minecraft_max_lines_per_sec': max_lines_per_second(rcon.commands),
+            'discord_rate_limited': discord.rate_limited,
+            'dropped': dropped_count(script, 'discord') + dropped_count(script, 'minecraft') - dropped_before,
+        }
+        for server in (onecomme, rcon, discord, reward):
+            server.shutdown()
+    return results
+
+# 取り込み: 長い配信でワンコメの応答が大きくなったとき、1回のポーリングにかかるCPU時間
+# 応答を丸ごとJSONとして読んで全件を調べる方法と、high-water markより後ろだけを読む方法を比べる
+def bench_ingest(args):
+    import requests
+    from datetime import datetime
+
+    script = import_relay(use_comment_stream=False)
+    results = {}
+    for count in args.comments:
+        onecomme = FakeOneCommeServer(rate=0, window=count + args.polls * args.new_per_poll)
+        for _ in range(count):
+            onecomme.add_comment()
+        onecomme.start()
+        reward = FakeRewardServer().start()
+        script.processed_comments = script.ProcessedCommentStore(':memory:')
+        script.live_comments_tracker = script.LiveCommentTracker()
+        script.reward_outbox = script.RewardOutbox(':memory:')
+        script.REWARD_API_URL = reward.url
+        script.relay_routes = {}
+        script.high_water_marks.clear()
+        script.parse_timestamp.cache_clear()
+
+        # 1回目は全件が新しいコメントなので計測しない（処理済みの記録を作るため）
+        with quiet():
+            script.fetch_comments(onecomme.url)
+
+        def legacy():
+            comments = requests.get(onecomme.url, timeout=30).json()
+            [comment for comment in comments
+             if comment['data']['id'] not in script.processed_comments
+             and datetime.fromisoformat(comment['data']['timestamp'])]
+
+        def incremental():
+            with quiet():
+                script.fetch_comments(onecomme.url)
+
+        row = {}
+        for mode, poll in (('full_parse', legacy), ('incremental', incremental)):
+            cpu = []
+            wall = []
+            for _ in range(args.polls):
+                for _ in range(args.new_per_poll):
+                    onecomme.add_comment()
+                cpu_start = time.thread_time()
+                wall_start = time.perf_counter()
+                poll()
+                cpu.append((time.thread_time() - cpu_start) * 1000)
+                wall.append((time.perf_counter() - wall_start) * 1000)
+            row[mode] = {'cpu_ms_per_poll': sum(cpu) / len(cpu), 'wall_ms_per_poll': sum(wall) / len(wall)}
+        row['response_bytes'] = len(json.dumps(onecomme.comments, ensure_ascii=False).encode('utf-8'))
+        results[str(count)] = row
+        for server in (onecomme, reward):
+            server.shutdown()
+    return results
+
+# 送信先の分離: 途中でRCONの接続が1本止まったときに、送信先をスレッドで動かす場合（thread）と
+# 別プロセスで動かす場合（process）で、Minecraftに届くコメント数と遅れ、ポーリングを続けられたかを比べる
+def bench_isolation(args):
+    import _thread
+    import subprocess
+
+    # 止まった送信スレッドは前の回が終わっても残るので、モードごとに別のプロセスで計測する
+    if len(args.modes) > 1:
+        results = {}
+        for mode in args.modes:
+            command = [sys.executable, os.path.join(BENCH_DIR, 'bench.py'), 'isolation', '--modes', mode]
+            for option in ('rate', 'duration', 'drain', 'wedge_at', 'wedge', 'timeout', 'interval'):
+                command += ['--' + option.replace('_', '-'), str(getattr(args, option))]
+            output = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', check=True).stdout
+            results.update(json.loads(output))
+        return results
+
+    script = import_relay(polling_interval=args.interval, use_comment_stream=False)
+    results = {}
+    for mode in args.modes:
+        onecomme = FakeOneCommeServer(rate=args.rate).start()
+        rcon = FakeRconServer().start()
+        discord = FakeDiscordServer().start()
+        reward = FakeRewardServer().start()
+
+        # 同じプロセスで続けて動かすので、前の回の状態を作り直す
+        script.config.update(api_endpoint=onecomme.url, discord_webhook_url=discord.url, minecraft_rcon_port=rcon.port)
+        script.processed_comments = script.ProcessedCommentStore(':memory:')
+        script.live_comments_tracker = script.LiveCommentTracker()
+        script.reward_outbox = script.RewardOutbox(':memory:')
+        script.REWARD_API_URL = reward.url
+        script.SINK_ISOLATION = mode
+        script.SINK_PROCESS_TIMEOUT = args.timeout
+        dropped_before = dropped_count(script, 'minecraft')
+
+        def drive():
+            wedge = threading.Timer(args.wedge_at, rcon.wedge, args=(args.wedge,))
+            wedge.daemon = True
+            wedge.start()
+            onecomme.generate(args.duration)
+            time.sleep(args.drain)
+            _thread.interrupt_main()
+        threading.Thread(target=drive, daemon=True).start()
+
+        error = None
+        usage_before = process_usage()
+        with quiet():
+            try:
+                script.poll_comments()
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                # 送信先の異常でリレー全体が止まった
+                error = repr(e)
+        usage_after = process_usage()
+
+        results[mode] = {
+            'generated': len(onecomme.created),
+            'polls': onecomme.requests,
+            'relay_error': error,
+            'discord': dict(percentiles(delivery_latencies(onecomme.created, discord.comments())),
+                            webhook_calls=len(discord.messages),
+                            rate_limited=discord.rate_limited),
+            'minecraft': dict(percentiles(delivery_latencies(onecomme.created, rcon.commands)),
+                              rcon_logins=rcon.logins,
+                              dropped=dropped_count(script, 'minecraft') - dropped_before),
+            'sink_restarts': sum(value for (name, labels), value in script.metrics.counters.items()
+                                 if name == 'commentrelay_sink_restarts_total'),
+            'main_process_cpu_seconds': usage_after['cpu_seconds'] - usage_before['cpu_seconds'],
+        }
+        for server in (onecomme, rcon, discord, reward):
+            server.shutdown()
+    return results
+
+# プロセス全体のCPU時間と最大メモリ使用量
+def process_usage():
+    try:
+        import resource
+    except ImportError:
+        # Windowsにはresourceが無いのでCPU時間だけ測る
+        return {'cpu_seconds': time.process_time(), 'max_rss_mb': None}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_mb': usage.ru_maxrss / 1024}
+
+
+# 起動: script.pyを別プロセスで起動してから、最初のコメントが各送信先に届くまでの時間
+# Webhookの確認が遅い場合や、処理済みコメントの履歴が多い場合でも待たされないか確かめる
+def bench_startup(args):
+    import sqlite3
+    import subprocess
+
+    onecomme = FakeOneCommeServer(rate=0).start()
+    onecomme.add_comment()
+    rcon = FakeRconServer().start()
+    discord = FakeDiscordServer(check_latency=args.webhook_latency).start()
+    workdir = make_workdir(
+        api_endpoint=onecomme.url,
+        discord_webhook_url=discord.url,
+        minecraft_rcon_port=rcon.port,
+        use_comment_stream=False,
+    )
+
+    if args.history:
+        conn = sqlite3.connect(os.path.join(workdir, 'processed_comments.db'))
+        conn.execute('CREATE TABLE processed_comments (id TEXT PRIMARY KEY, timestamp REAL NOT NULL, live_id TEXT)')
+        now = time.time()
+        conn.executemany('INSERT INTO processed_comments VALUES (?, ?, ?)',
+                         ((f'history-{i}', now - i / 1000, 'live') for i in range(args.history)))
+        conn.commit()
+        conn.close()
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'script.py'), '--headless'], cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first = {}
+    deadline = time.perf_counter() + args.timeout
+    while len(first) < 2 and time.perf_counter() < deadline:
+        if 'minecraft' not in first and rcon.commands:
+            first['minecraft'] = rcon.commands[0][0] - start
+        if 'discord' not in first and discord.messages:
+            first['discord'] = discord.messages[0][0] - start
+        time.sleep(0.001)
+    process.kill()
+    process.wait()
+
+    onecomme.shutdown()
+    rcon.shutdown()
+    discord.shutdown()
+    return {
+        'webhook_check_latency': args.webhook_latency,
+        'history': args.history,
+        'first_delivery_ms': {sink: seconds * 1000 for sink, seconds in first.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CommentRelayのベンチマーク')
+    parser.add_argument('--json', help='結果をJSONで保存するファイル')
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+    rcon = subparsers.add_parser('rcon', help='RCON接続プールの有無で送信速度を比較')
+    rcon.add_argument('--comments', type=int, default=500)
+    rcon.add_argument('--login-latency', type=float, default=0.002, help='偽サーバーのログイン処理時間（秒）')
+    rcon.add_argument('--command-latency', type=float, default=0.0, help='偽サーバーのコマンド処理時間（秒）')
+    rcon.set_defaults(func=bench_rcon)
+
+    discord = subparsers.add_parser('discord', help='レート制限のある偽Webhookへの送信を比較')
+    discord.add_argument('--comments', type=int, default=100)
+    discord.add_argument('--rate', type=float, default=20, help='1秒あたりに届くコメント数')
+    discord.add_argument('--limit', type=int, default=5, help='偽Webhookが許す送信回数')
+    discord.add_argument('--window', type=float, default=2.0, help='送信回数を数える時間（秒）')
+    discord.set_defaults(func=bench_discord)
+
+    expiry = subparsers.add_parser('expiry', help='期限切れコメントの削除にかかる時間を比較')
+    expiry.add_argument('--ids', type=int, default=1_000_000, help='保持している処理済みコメント数')
+    expiry.add_argument('--polls', type=int, default=5)
+    expiry.add_argument('--expired-per-poll', type=int, default=10)
+    expiry.set_defaults(func=bench_expiry)
+
+    memory = subparsers.add_parser('memory', help='処理済みコメントと初コメント判定のメモリ使用量を比較')
+    memory.add_argument('--comments', type=int, default=1_000_000)
+    memory.add_argument('--lives', type=int, default=20, help='配信枠の数')
+    memory.add_argument('--users', type=int, default=50_000, help='視聴者の数')
+    memory.set_defaults(func=bench_memory)
+
+    render = subparsers.add_parser('render', help='コメント1件の整形にかかる時間を比較')
+    render.add_argument('--comments', type=int, default=100_000)
+    render.add_argument('--emoji-rate', type=float, default=0.3, help='絵文字を含むコメントの割合')
+    render.set_defaults(func=bench_render)
+
+    reward = subparsers.add_parser('reward', help='障害を混ぜた偽報酬APIへ送信箱から送る')
+    reward.add_argument('--rewards', type=int, default=200)
+    reward.add_argument('--fail-rate', type=float, default=0.3, help='偽APIが503を返す割合')
+    reward.add_argument('--down-seconds', type=float, default=1.0, help='開始直後に偽APIが落ちている時間（秒）')
+    reward.add_argument('--timeout', type=float, default=60)
+    reward.set_defaults(func=bench_reward)
+
+    e2e = subparsers.add_parser('e2e', help='偽ワンコメ・偽RCON・偽Discordを相手にリレー全体を動かす')
+    e2e.add_argument('--duration', type=float, default=20, help='コメントを作り続ける時間（秒）')
+    e2e.add_argument('--drain', type=float, default=5, help='作り終えてから送信を待つ時間（秒）')
+    e2e.add_argument('--rate', type=float, default=5, help='1秒あたりのコメント数')
+    e2e.add_argument('--burst-size', type=int, default=50, help='まとめて届くコメント数')
+    e2e.add_argument('--burst-every', type=float, default=10, help='まとめて届く間隔（秒）')
+    e2e.add_argument('--window', type=int, default=200, help='偽ワンコメが1回に返すコメント数')
+    e2e.add_argument('--users', type=int, default=100, help='視聴者の数')
+    e2e.add_argument('--interval', type=float, default=1, help='リレーのpolling_interval')
+    e2e.add_argument('--rcon-latency', type=float, default=0.005, help='偽RCONサーバーの応答時間（秒）')
+    e2e.add_argument('--discord-limit', type=int, default=5)
+    e2e.add_argument('--discord-window', type=float, default=2.0)
+    e2e.set_defaults(func=bench_e2e)
+
+    startup = subparsers.add_parser('startup', help='起動してから最初のコメントが届くまでの時間')
+    startup.add_argument('--webhook-latency', type=float, default=3.0, help='偽WebhookがGETに答えるまでの時間（秒）')
+    startup.add_argument('--history', type=int, default=200_000, help='あらかじめ入れておく処理済みコメント数')
+    startup.add_argument('--timeout', type=float, default=30)
+    startup.set_defaults(func=bench_startup)
+
+    routing = subparsers.add_parser('routing', help='複数の配信を1つのプロセスで複数の送信先に中継する')
+    routing.add_argument('--sources', type=int, default=3, help='配信（偽ワンコメ）の数')
+    routing.add_argument('--servers', type=int, default=4, help='Minecraftサーバー（偽RCON）の数')
+    routing.add_argument('--duration', type=float, default=10, help='コメントを作り続ける時間（秒）')
+    routing.add_argument('--drain', type=float, default=5, help='作り終えてから送信を待つ時間（秒）')
+    routing.add_argument('--rate', type=float, default=2, help='配信ごとの1秒あたりのコメント数')
+    routing.add_argument('--interval', type=float, default=1, help='リレーのpolling_interval')
+    routing.set_defaults(func=bench_routing)
+
+    catchup = subparsers.add_parser('catchup', help='再起動直後に溜まっていたコメントの送り方を比較')
+    catchup.add_argument('--backlog', type=int, default=100, help='停止中に溜まっていたコメント数')
+    catchup.add_argument('--backlog-age', type=float, default=300, help='溜まっていたコメントが投稿された時刻（何秒前か）')
+    catchup.add_argument('--rate', type=float, default=10, help='catchup_rate（1秒あたりの件数）')
+    catchup.add_argument('--live-rate', type=float, default=2, help='再起動後に届く新しいコメントの1秒あたりの件数')
+    catchup.add_argument('--duration', type=float, default=12, help='新しいコメントを作り続ける時間（秒）')
+    catchup.add_argument('--drain', type=float, default=3, help='作り終えてから送信を待つ時間（秒）')
+    catchup.add_argument('--interval', type=float, default=1, help='リレーのpolling_interval')
+    catchup.set_defaults(func=bench_catchup)
+
+    ingest = subparsers.add_parser('ingest', help='ワンコメの応答が大きいときの1回のポーリングのCPU時間を比較')
+    ingest.add_argument('--comments', type=int, nargs='+', default=[10000, 100000], help='応答に含まれるコメント数')
+    ingest.add_argument('--polls', type=int, default=10, help='計測するポーリング回数')
+    ingest.add_argument('--new-per-poll', type=int, default=5, help='ポーリングの間に増えるコメント数')
+    ingest.set_defaults(func=bench_ingest)
+
+    isolation = subparsers.add_parser('isolation', help='RCONの接続が止まったときの送信スレッドと送信プロセスを比較')
+    isolation.add_argument('--modes', nargs='+', default=['thread', 'process'], help='比べるsink_isolation')
+    isolation.add_argument('--rate', type=float, default=5, help='1秒あたりのコメント数')
+    isolation.add_argument('--duration', type=float, default=20, help='コメントを作り続ける時間（秒）')
+    isolation.add_argument('--drain', type=float, default=5, help='作り終えてから送信を待つ時間（秒）')
+    isolation.add_argument('--wedge-at', type=float, default=5, help='RCONの接続を止める時刻（開始から何秒後か）')
+    isolation.add_argument('--wedge', type=float, default=60, help='接続を止めておく時間（秒）')
+    isolation.add_argument('--timeout', type=float, default=3, help='sink_process_timeout（秒）')
+    isolation.add_argument('--interval', type=float, default=1, help='リレーのpolling_interval')
+    isolation.set_defaults(func=bench_isolation)
+
+    args = parser.parse_args()
+    # import_relayが作業ディレクトリを移動するので先に絶対パスにしておく
+    output = os.path.abspath(args.json) if args.json else None
+    results = args.func(args)
+    print(json.dumps(results, ensure_ascii=False, indent=4))
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=4)
+
+if __name__ == "__main__":
+    main()
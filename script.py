@@ -3,70 +3,482 @@ import json
 import requests
 import time
 from datetime import datetime, timedelta, timezone
-import tkinter as tk
-from tkinter import messagebox
 import sys
-from mcrcon import MCRcon
+import argparse
+import atexit
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
 import re
 import subprocess
+import threading
+import queue
+import heapq
+import logging
+import logging.handlers
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from array import array
+import sqlite3
+import html
+import string
+import tempfile
+import functools
+from collections import deque, namedtuple
+
+# ワンコメのWebSocketからコメントを受け取るのに使う（無い場合はポーリングのみで動く）
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+# exeから起動された送信プロセス（sink_isolation: "process"）は、設定やDBに触れる前にここで送信だけを行って終わる
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+# spawnで起動された送信プロセスでは、このファイルも__mp_main__として読み込み直される。
+# そのときは設定ファイルの作成・DBのオープン・ログの書き出しを行わない（送信プロセスで動く部分はsenders.pyにある）
+IS_SINK_PROCESS = __name__ == '__mp_main__'
+
+from senders import (
+    HTTP_TIMEOUT, DISCORD_MAX_EMBEDS, DiscordSender, metrics, rcon_pool, send_minecraft_batch, run_sink_process,
+)
 
 # デフォルトのコンフィグ設定
 default_config = {
     'discord_webhook_url': 'https://discord.com/api/webhooks/your_webhook_url_here',
     "api_endpoint": "http://localhost:11180/api/comments",
     "polling_interval": 1,
+    "polling_interval_min": 0.25,
+    "polling_interval_max": 5,
     "comment_expiry_days": 1,
     "minecraft_rcon_host": "localhost",
     "minecraft_rcon_port": 25575,
     "minecraft_rcon_password": "test",
     "custom_format": "<{display_name}>:{message}",
-    "message_color": "yellow"
+    "message_color": "yellow",
+    "use_comment_stream": True,
+    "comment_stream_endpoint": "",
+    "log_level": "INFO",
+    "metrics_port": 0,
+    "metrics_summary_interval": 0,
+    "discord_queue_size": 100,
+    "discord_overflow_policy": "collapse",
+    "minecraft_queue_size": 200,
+    "minecraft_overflow_policy": "collapse",
+    "sources": [],
+    "sinks": [],
+    "routes": [],
+    "catchup_window_minutes": 60,
+    "catchup_after_seconds": 30,
+    "catchup_rate": 2,
+    "catchup_summary": False,
+    "sink_isolation": "thread",
+    "sink_process_timeout": 15
 }
 
 # ファイルパス
 config_path = 'config.json'
-processed_comments_file = 'processed_comments.json'
+processed_comments_file = 'processed_comments.json'  # 旧形式（初回起動時にDBへ移行する）
+processed_comments_db = 'processed_comments.db'
+
+# JSONを一時ファイルに書いてから置き換える（読み込む側が書きかけのファイルを見ないように）
+def write_json_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                     dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, indent=4)
+        # Windowsでは相手がファイルを開いている一瞬だけ置き換えに失敗することがあるので少し待ってやり直す
+        for attempt in range(5):
+            try:
+                os.replace(temp_path, path)
+                return
+            except PermissionError:
+                if attempt == 4:
+                    raise
+                time.sleep(0.05)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
 
 # コンフィグの初期化
-if not os.path.exists(config_path):
-    with open(config_path, 'w', encoding='utf-8') as file:
-        json.dump(default_config, file, ensure_ascii=False, indent=4)
+if IS_SINK_PROCESS:
+    config = {}
+else:
+    if not os.path.exists(config_path):
+        write_json_atomic(config_path, default_config)
 
-with open(config_path, 'r', encoding='utf-8') as file:
-    config = json.load(file)
+    with open(config_path, 'r', encoding='utf-8') as file:
+        config = json.load(file)
 
 for key, value in default_config.items():
     config.setdefault(key, value)
 
+# ポーリング間隔を (目標, 最小, 最大) で返す。最小 <= 目標 <= 最大 になるようにする
+def polling_intervals(config):
+    interval = float(config['polling_interval'])
+    minimum = min(float(config['polling_interval_min']), interval)
+    maximum = max(float(config['polling_interval_max']), interval)
+    if minimum <= 0:
+        raise ValueError("polling_intervalとpolling_interval_minは0より大きくしてください。")
+    return interval, minimum, maximum
+
 # コンフィグ変数
 DISCORD_WEBHOOK_URL = config['discord_webhook_url']
 API_ENDPOINT = config['api_endpoint']
-POLL_INTERVAL = config['polling_interval']
+POLL_INTERVAL, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX = polling_intervals(config)
 COMMENT_EXPIRY_DAYS = config['comment_expiry_days']
 MINECRAFT_RCON_HOST = config['minecraft_rcon_host']
 MINECRAFT_RCON_PORT = config['minecraft_rcon_port']
 MINECRAFT_RCON_PASSWORD = config['minecraft_rcon_password']
+USE_COMMENT_STREAM = config['use_comment_stream']
+COMMENT_STREAM_ENDPOINT = config['comment_stream_endpoint']
+LOG_LEVEL = config['log_level']
+METRICS_PORT = config['metrics_port']                          # 0なら計測値のHTTP公開をしない
+METRICS_SUMMARY_INTERVAL = config['metrics_summary_interval']  # 0なら要約を出さない
+DISCORD_QUEUE_SIZE = config['discord_queue_size']
+DISCORD_OVERFLOW_POLICY = config['discord_overflow_policy']        # drop_oldest / sample / collapse
+MINECRAFT_QUEUE_SIZE = config['minecraft_queue_size']
+MINECRAFT_OVERFLOW_POLICY = config['minecraft_overflow_policy']
+CATCHUP_WINDOW_MINUTES = config['catchup_window_minutes']  # これより前のコメントは起動時に送らない
+CATCHUP_AFTER_SECONDS = config['catchup_after_seconds']    # これより前のコメントは溜まっていた分として扱う
+CATCHUP_RATE = config['catchup_rate']                      # 溜まっていた分を送る速さ（1秒あたりの件数、0なら制限しない）
+CATCHUP_SUMMARY = config['catchup_summary']                # 溜まっていた通常のコメントを件数だけにまとめる
+SINK_ISOLATION = config['sink_isolation']                  # thread / process（送信先ごとに別プロセスで送る）
+SINK_PROCESS_TIMEOUT = config['sink_process_timeout']      # 送信プロセスが知らせた処理時間をこの秒数過ぎても返事が無ければ作り直す
 
-# processed_commentsの読み込みと初期化
-def load_processed_comments():
-    if os.path.exists(processed_comments_file):
+# ログ
+# コンソールへの書き込みは別スレッド（QueueListener）に任せ、コメント処理のスレッドを待たせない
+logger = logging.getLogger('commentrelay')
+log_listener = None
+
+def setup_logging(level):
+    global log_listener
+    if log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%H:%M:%S'))
+    log_listener = logging.handlers.QueueListener(log_queue, console)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+    log_listener.start()
+    # 終了する直前のログ（再生の結果など）も書き出してから終わる
+    atexit.register(log_listener.stop)
+
+if not IS_SINK_PROCESS:
+    setup_logging(LOG_LEVEL)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# http://127.0.0.1:<port>/metrics で計測値を公開する（ローカルからのみ）
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("計測値を公開しています: http://127.0.0.1:%d/metrics", port)
+    return server
+
+# 一定間隔で計測値の要約をログに出す
+def start_metrics_summary(interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            logger.info("stats %s", metrics.summary())
+    threading.Thread(target=run, name="metrics-summary", daemon=True).start()
+
+# 処理済みコメントの保存先
+# SQLite(WALモード)に新しく処理したIDだけを書き足すので、途中で落ちても壊れず、毎回全件を書き直すこともない
+# 重複判定はメモリ上の辞書で行い、DBは起動時の読み込みと永続化だけに使う
+# 期限切れの判定のため、処理した順（=処理時刻順）にIDと時刻を並べた配列も持つ
+# 長時間の配信でも増え方を抑えるよう、1件あたりのオブジェクトは作らない
+# （時刻はarrayにdoubleのまま詰め、live_idは同じ文字列オブジェクトを共有する）
+class ProcessedCommentStore:
+    # 期限切れで先頭に溜まった空きがこの件数を超えたら詰め直す
+    COMPACT_THRESHOLD = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.comments = {}             # コメントID -> live_id
+        self.order_ids = []            # 処理した順のコメントID
+        self.order_times = array('d')  # order_idsと同じ並びの処理時刻(UNIX秒)
+        self.head = 0                  # order_*の先頭から期限切れで消えた数
+        self.pending_adds = []
+        self.pending_expiry = None
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS processed_comments ('
+            'id TEXT PRIMARY KEY, timestamp REAL NOT NULL, live_id TEXT)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS processed_comments_timestamp ON processed_comments (timestamp)')
+        self.conn.commit()
+
+    def load(self):
+        with self.lock:
+            for comment_id, timestamp, live_id in self.conn.execute(
+                    'SELECT id, timestamp, live_id FROM processed_comments ORDER BY timestamp'):
+                self.append(comment_id, timestamp, live_id)
+        self.loaded.set()
+
+    # 履歴の読み込みを別スレッドで行い、起動直後からコメントを処理できるようにする
+    # 読み込みが終わるまでは、メモリに無いIDをDBに直接問い合わせて重複を判定する
+    def load_in_background(self):
+        if self.path == ':memory:':
+            self.load()
+            return
+        threading.Thread(target=self.load_from_db, name="history-loader", daemon=True).start()
+
+    def load_from_db(self):
+        conn = sqlite3.connect(self.path)
         try:
-            
-            with open(processed_comments_file, 'r', encoding='utf-8') as file:
-                return json.load(file)
+            rows = conn.execute('SELECT id, timestamp, live_id FROM processed_comments ORDER BY timestamp').fetchall()
+        finally:
+            conn.close()
+
+        comments = {}
+        ids = []
+        times = array('d')
+        for comment_id, timestamp, live_id in rows:
+            comments[comment_id] = sys.intern(live_id) if live_id else live_id
+            ids.append(comment_id)
+            times.append(timestamp)
+        del rows
+
+        # 読み込み中に処理したコメントは読み込んだ履歴より新しいので後ろにつなげる
+        with self.lock:
+            if self.comments:
+                keep = [i for i, comment_id in enumerate(ids) if comment_id not in self.comments]
+                ids = [ids[i] for i in keep]
+                times = array('d', (times[i] for i in keep))
+            comments.update(self.comments)
+            self.comments = comments
+            self.order_ids = ids + self.order_ids[self.head:]
+            self.order_times = times + self.order_times[self.head:]
+            self.head = 0
+        self.loaded.set()
+        logger.info("処理済みコメントの履歴を読み込みました: %d件", len(comments))
+
+    # 旧形式のprocessed_comments.jsonがあれば取り込み、二重に取り込まないよう名前を変えておく
+    def migrate_json(self, json_path):
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as file:
+                legacy = json.load(file)
         except (json.JSONDecodeError, IOError):
-            print("Error loading processed comments. Reinitializing...")
-    return {}
+            logger.warning("Error loading processed comments. Reinitializing...")
+            legacy = {}
+        for comment_id, (timestamp, live_id) in sorted(legacy.items(), key=lambda item: item[1][0]):
+            if comment_id not in self.comments:
+                self.add(comment_id, datetime.fromisoformat(timestamp).timestamp(), live_id)
+        self.flush()
+        os.replace(json_path, json_path + '.migrated')
+        logger.info("%sから%d件の処理済みコメントを移行しました。", json_path, len(legacy))
+
+    def __contains__(self, comment_id):
+        loaded = self.loaded.is_set()
+        if comment_id in self.comments:
+            return True
+        if loaded:
+            return False
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM processed_comments WHERE id = ?', (comment_id,)).fetchone() is not None
+
+    def __len__(self):
+        return len(self.comments)
+
+    def append(self, comment_id, timestamp, live_id):
+        self.comments[comment_id] = sys.intern(live_id) if live_id else live_id
+        self.order_ids.append(comment_id)
+        self.order_times.append(timestamp)
+
+    def add(self, comment_id, timestamp, live_id):
+        with self.lock:
+            if comment_id in self.comments:
+                return
+            self.append(comment_id, timestamp, live_id)
+            self.pending_adds.append((comment_id, timestamp, live_id))
+
+    # expiry_timeより前に処理したコメントを消す
+    # 古い順に並んでいるので、期限切れのものだけを先頭から取り出せば済む
+    def expire(self, expiry_time):
+        with self.lock:
+            return self.expire_locked(expiry_time)
+
+    def expire_locked(self, expiry_time):
+        ids = self.order_ids
+        times = self.order_times
+        start = head = self.head
+        while head < len(times) and times[head] < expiry_time:
+            self.comments.pop(ids[head], None)
+            ids[head] = None
+            head += 1
+        self.head = head
+        if head > self.COMPACT_THRESHOLD and head * 2 > len(times):
+            del ids[:head]
+            del times[:head]
+            self.head = 0
+        expired = head - start
+        if expired:
+            self.pending_expiry = expiry_time
+        return expired
+
+    # 溜まった変更を1回のトランザクションでまとめて書き込む（変更が無ければ何もしない）
+    def flush(self):
+        with self.lock:
+            if not self.pending_adds and self.pending_expiry is None:
+                return
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO processed_comments VALUES (?, ?, ?)', self.pending_adds)
+                if self.pending_expiry is not None:
+                    self.conn.execute('DELETE FROM processed_comments WHERE timestamp < ?', (self.pending_expiry,))
+            self.pending_adds.clear()
+            self.pending_expiry = None
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+# processed_commentsの読み込みと初期化
+# DBを開くだけにして、履歴の読み込みは起動時（poll_comments）に別スレッドで行う
+def load_processed_comments():
+    # 送信プロセスでは使わないので、DBファイルを開かずメモリ上に置く
+    if IS_SINK_PROCESS:
+        return ProcessedCommentStore(':memory:')
+    store = ProcessedCommentStore(processed_comments_db)
+    store.migrate_json(processed_comments_file)
+    return store
 
 processed_comments = load_processed_comments()
+metrics.gauge('commentrelay_processed_comments', lambda: len(processed_comments))
+
+# メッセージの整形
+# コメント本文のHTMLの後始末はコメント1件につき1回だけ行い、各送信先の形はその結果から作る
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+IMG_ALT_PATTERN = re.compile(r'\balt="([^"]*)"')
+TAG_FALLBACK_CACHE_SIZE = 4096
+
+# タグ -> 代わりに表示する文字列
+# 絵文字の<img>はaltの文字（:_絵文字名:など）にし、それ以外のタグは消す。
+# 同じ絵文字は何度も使われるので、一度調べたタグは覚えておく
+tag_fallbacks = {}
 
-# メッセージからURLやHTMLタグを除外する関数
-def remove_img_tags(text):
-    # <img src="...">の部分を削除
-    img_tag_pattern = r'<img src=".*?" alt=".*?"\s*/?>'
-    text = re.sub(img_tag_pattern, '', text)
+def tag_fallback(match):
+    tag = match.group(0)
+    fallback = tag_fallbacks.get(tag)
+    if fallback is None:
+        alt = IMG_ALT_PATTERN.search(tag) if tag[:4].lower() == '<img' else None
+        fallback = alt.group(1) if alt else ''
+        if len(tag_fallbacks) >= TAG_FALLBACK_CACHE_SIZE:
+            tag_fallbacks.clear()
+        tag_fallbacks[tag] = fallback
+    return fallback
+
+# タグを取り除き、&amp;などの文字参照を元の文字に戻す
+def clean_comment_text(text):
+    if '<' in text:
+        text = HTML_TAG_PATTERN.sub(tag_fallback, text)
+    if '&' in text:
+        text = html.unescape(text)
     return text
 
+# 全送信先で共通の、整形済みのコメント1件分
+CleanComment = namedtuple('CleanComment', ['display_name', 'text', 'timestamp', 'avatar_url'])
+
+# 空のメッセージならNone
+def clean_comment(display_name, text, timestamp, original_profile_image_url):
+    text = clean_comment_text(text)
+    if not text.strip():
+        logger.debug("空のメッセージは送信しません。")
+        return None
+    return CleanComment(display_name, text, timestamp, original_profile_image_url)
+
+# カスタムフォーマットで使える項目
+MESSAGE_FORMAT_FIELDS = ('display_name', 'message', 'timestamp', 'color')
+# カスタムフォーマットが使えないときの形
+FALLBACK_MESSAGE_FORMAT = "<{display_name}> {message} ({color})"
+FORMAT_CONVERSIONS = {'s': str, 'r': repr, 'a': ascii}
+
+# custom_formatは読み込んだときに1回だけ解析・検証し、コメントごとには値を埋めるだけにする
+# 使えないフォーマットはここで1回だけ警告してデフォルトの形に戻す
+class MessageTemplate:
+    def __init__(self, custom_format, color):
+        self.custom_format = custom_format
+        self.color = color
+        try:
+            self.build(custom_format)
+            self.render('', '', '')  # 書式指定の誤りもここで見つける
+        except (KeyError, ValueError) as e:
+            logger.warning("無効なフォーマットです: %s. デフォルトフォーマットに戻します。", e)
+            self.build(FALLBACK_MESSAGE_FORMAT)
+
+    def build(self, custom_format):
+        self.parts = self.compile(custom_format)
+        # 変換や書式指定の無いフォーマット（ほとんどがこれ）は%形式の文字列にしておく
+        self.pattern = None
+        if all(part.__class__ is str or (not part[1] and not part[2]) for part in self.parts):
+            self.pattern = ''.join(part.replace('%', '%%') if part.__class__ is str else '%s' for part in self.parts)
+            self.field_indexes = [MESSAGE_FORMAT_FIELDS.index(part[0]) for part in self.parts if part.__class__ is not str]
+
+    # 固定の文字列と(項目名, 変換, 書式)の組を並べたリストにする
+    @staticmethod
+    def compile(custom_format):
+        parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(custom_format):
+            if literal:
+                parts.append(literal)
+            if field is None:
+                continue
+            if field not in MESSAGE_FORMAT_FIELDS:
+                raise KeyError(field)
+            if conversion and conversion not in FORMAT_CONVERSIONS:
+                raise ValueError(f"Unknown conversion specifier {conversion}")
+            parts.append((field, conversion, format_spec))
+        return parts
+
+    def render(self, display_name, message, timestamp):
+        if self.pattern is not None:
+            values = (display_name, message, timestamp, self.color)
+            return self.pattern % tuple([values[index] for index in self.field_indexes])
+
+        values = {'display_name': display_name, 'message': message, 'timestamp': timestamp, 'color': self.color}
+        pieces = []
+        for part in self.parts:
+            if part.__class__ is str:
+                pieces.append(part)
+                continue
+            field, conversion, format_spec = part
+            value = values[field]
+            if conversion:
+                value = FORMAT_CONVERSIONS[conversion](value)
+            pieces.append(format(value, format_spec) if format_spec else value)
+        return ''.join(pieces)
+
+message_template = MessageTemplate(config['custom_format'], config['message_color'])
+
 # Discordにコメントを送信する関数
 import re
 import requests
@@ -74,221 +486,1739 @@ import requests
 # YouTubeのロゴURLをデフォルトのアイコンとして使用
 DEFAULT_AVATAR_URL = 'https://upload.wikimedia.org/wikipedia/commons/4/42/YouTube_icon_%282013-2017%29.png'
 
-def remove_img_tags(text):
-    # <img src="...">の部分を削除
-    img_tag_pattern = r'<img src=".*?" alt=".*?"\s*/?>'
-    text = re.sub(img_tag_pattern, '', text)
-    return text
-
 def is_valid_url(url):
     # HTTP/HTTPS以外のURL形式を無効として扱う
     return url.startswith('http://') or url.startswith('https://')
 
-def send_to_discord(display_name, text, original_profile_image_url):
-    try:
-        # メッセージから<img>タグを削除
-        text_cleaned = remove_img_tags(text)
+# 整形済みのコメントからDiscordに送る1コメント分のデータを作る
+def discord_message(comment):
+    # avatar_urlが有効なURLか確認し、無効ならデフォルトアイコンを設定
+    avatar_url = comment.avatar_url if is_valid_url(comment.avatar_url) else DEFAULT_AVATAR_URL
+    return (comment.display_name, comment.text, avatar_url)
 
-        # メッセージが空の場合は送信しない
-        if not text_cleaned.strip():
-            print(f"空のメッセージはDiscordに送信しません。")
-            return
+discord_sender = DiscordSender(DISCORD_WEBHOOK_URL)
 
-        # avatar_urlが有効なURLか確認し、無効ならデフォルトアイコンを設定
-        avatar_url = original_profile_image_url if is_valid_url(original_profile_image_url) else DEFAULT_AVATAR_URL
+# 送信スレッドから呼ばれる。キューに溜まっていた複数のコメント（discord_messageの形）をまとめて送る
+def send_discord_batch(messages, sender=None):
+    if messages:
+        (sender or discord_sender).send(messages)
 
-        # 除去後のメッセージを送信
-        payload = {
-            'username': display_name,
-            'content': text_cleaned,
-            'avatar_url': avatar_url  # アイコンを追加
-        }
-        headers = {
-            'Content-Type': 'application/json'
-        }
+# 1回のtellrawにまとめるコメント数の上限
+MINECRAFT_MAX_BATCH = 20
 
-        print(f"送信するペイロード: {payload}")  # 送信前にペイロードを表示
+# 整形済みのコメントから、Minecraftに表示する1コメント分のテキスト成分を作る
+def minecraft_message(comment, template=None):
+    template = template or message_template
+    text = template.render(comment.display_name, comment.text, comment.timestamp)
+    return {'text': text, 'color': template.color}
 
-        response = requests.post(DISCORD_WEBHOOK_URL, json=payload, headers=headers)
-        response.raise_for_status()  # エラーチェック
-        print(f"Discordにコメントを送信しました: [{display_name}] {text_cleaned}")
 
-    except requests.exceptions.RequestException as e:
-        print(f"Discordへのコメント送信でエラーが発生しました: {e}")
-        if e.response:
-            print(f"エラーレスポンス: {e.response.text}")  # エラーレスポンスを表示
+# 初コメント判定用
+# 配信枠ごとにコメントしたユーザーIDを覚えておく。同じユーザーIDの文字列は枠をまたいで共有し、
+# 最後のコメントから期限（comment_expiry_days）が過ぎた枠は終わったものとして丸ごと捨てる
+class LiveCommentTracker:
+    def __init__(self):
+        self.users = {}      # live_id -> その枠でコメントしたユーザーIDのset
+        self.last_seen = {}  # live_id -> その枠に最後にコメントが来た時刻(UNIX秒)
 
+    def __contains__(self, live_id):
+        return live_id in self.users
 
+    def __len__(self):
+        return len(self.users)
 
-def send_to_minecraft(text, timestamp, display_name):
-    try:
-        text_cleaned = remove_img_tags(text)
+    # この枠でのそのユーザーの初コメントかどうか
+    def is_first_time(self, live_id, user_id, timestamp):
+        live_id = sys.intern(live_id)
+        users = self.users.get(live_id)
+        if users is None:
+            self.users[live_id] = users = set()  # 新しい枠を初期化
+        self.last_seen[live_id] = timestamp
+        return user_id not in users
+
+    def add(self, live_id, user_id):
+        self.users[sys.intern(live_id)].add(sys.intern(user_id))
+
+    def expire(self, expiry_time):
+        ended = [live_id for live_id, timestamp in self.last_seen.items() if timestamp < expiry_time]
+        for live_id in ended:
+            del self.users[live_id]
+            del self.last_seen[live_id]
+        return len(ended)
+
+live_comments_tracker = LiveCommentTracker()
+metrics.gauge('commentrelay_live_trackers', lambda: len(live_comments_tracker))
+
+# 送信先ごとのキューに溜められるコメント数の上限（既定値）
+SINK_QUEUE_SIZE = 1000
+
+# 送信の優先度（小さいほど先に送る）
+PRIORITY_PAID = 0         # スーパーチャットなどの有料メッセージ
+PRIORITY_MEMBERSHIP = 1   # メンバーシップ加入
+PRIORITY_FIRST_TIME = 2   # その配信枠での初コメント
+PRIORITY_NORMAL = 3       # 通常のコメント
+PRIORITY_STOP = 9         # 送信スレッドを止める合図（残りを送り終えてから止める）
+
+# キューがあふれたときの扱い
+OVERFLOW_POLICIES = ('drop_oldest', 'sample', 'collapse')
+OVERFLOW_SAMPLE_EVERY = 5  # sampleのとき、あふれたコメントのうち何件に1件を残すか
+
+def comment_priority(data, is_first_time):
+    if data.get('hasGift') or data.get('paidText') or data.get('price'):
+        return PRIORITY_PAID
+    if data.get('membership'):
+        return PRIORITY_MEMBERSHIP
+    if is_first_time:
+        return PRIORITY_FIRST_TIME
+    return PRIORITY_NORMAL
+
+# 優先度付きで上限のある送信キュー
+# 同じ優先度の中では届いた順に取り出す。満杯のときはpolicyに従い、
+# 一番優先度の低い中で一番古いコメントを捨てて新しいコメントを入れる
+#   drop_oldest: 常に古いものを捨てる
+#   sample:      あふれたコメントはOVERFLOW_SAMPLE_EVERY件に1件だけ残し、それ以外は新しいものを捨てる
+#   collapse:    古いものを捨て、捨てた件数を「+N件のコメント」の1件にまとめて送る
+class DeliveryQueue:
+    SUMMARY = object()  # collapseでまとめた件数を送る位置の印
+
+    def __init__(self, name, maxsize=SINK_QUEUE_SIZE, policy='drop_oldest', summarize=None):
+        self.name = name
+        self.summarize = summarize
+        self.heap = []
+        self.sequence = 0
+        self.size = 0         # 件数（停止の合図とまとめの印は数えない）
+        self.unfinished = 0
+        self.overflowed = 0
+        self.collapsed = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        self.configure(maxsize, policy)
 
-        # メッセージが空の場合は送信しない
-        if not text_cleaned.strip():
-            print(f"空のメッセージはMinecraftに送信しません。")
+    # 大きさとあふれたときの扱いを変える（設定の再読み込みでも使う。入っているコメントはそのまま）
+    def configure(self, maxsize, policy):
+        if policy not in OVERFLOW_POLICIES:
+            logger.warning("%sのoverflow_policyが不正です: %s。drop_oldestを使います。", self.name, policy)
+            policy = 'drop_oldest'
+        if policy == 'collapse' and self.summarize is None:
+            policy = 'drop_oldest'
+        with self.lock:
+            self.maxsize = maxsize
+            self.policy = policy
+
+    def qsize(self):
+        return self.size
+
+    def push(self, priority, item):
+        self.sequence += 1
+        heapq.heappush(self.heap, (priority, self.sequence, item))
+        self.unfinished += 1
+        self.not_empty.notify()
+
+    # 取り出す前に捨てるコメントを選ぶ（優先度が一番低い中で一番古いもの）
+    def evict(self, priority):
+        victim = None
+        for index, (entry_priority, sequence, item) in enumerate(self.heap):
+            if item is None or item is self.SUMMARY:
+                continue
+            if victim is None or (entry_priority, -sequence) > (self.heap[victim][0], -self.heap[victim][1]):
+                victim = index
+        # 入っているものが全部新しいコメントより大事なら、新しい方を捨てる
+        if victim is None or self.heap[victim][0] < priority:
+            return False
+        self.heap[victim] = self.heap[-1]
+        self.heap.pop()
+        heapq.heapify(self.heap)
+        self.size -= 1
+        self.unfinished -= 1
+        return True
+
+    # 何も捨てずに入れられたらTrue、あふれて何かを捨てたらFalseを返す（ポーリングを待たせることはない）
+    def put(self, item, priority=PRIORITY_NORMAL):
+        with self.lock:
+            if self.size < self.maxsize:
+                self.push(priority, item)
+                self.size += 1
+                return True
+
+            self.overflowed += 1
+            # sampleでは、あふれた通常のコメントは一部だけを残す
+            if self.policy == 'sample' and priority >= PRIORITY_NORMAL and self.overflowed % OVERFLOW_SAMPLE_EVERY:
+                return False
+            evicted = self.evict(priority)
+            if self.policy == 'collapse':
+                # 入っていたものを捨てた場合も、新しいものを入れられなかった場合も「+N件」に数える
+                if not self.collapsed:
+                    # まとめの印は、残っている通常のコメントより先に送る
+                    heapq.heappush(self.heap, (PRIORITY_NORMAL, 0, self.SUMMARY))
+                    self.unfinished += 1
+                    self.not_empty.notify()
+                self.collapsed += 1
+            if not evicted:
+                return False
+            self.push(priority, item)
+            self.size += 1
+            return False
+
+    def put_stop(self):
+        with self.lock:
+            self.push(PRIORITY_STOP, None)
+
+    def pop(self):
+        _, _, item = heapq.heappop(self.heap)
+        if item is self.SUMMARY:
+            item = self.summarize(self.collapsed)
+            self.collapsed = 0
+        elif item is not None:
+            self.size -= 1
+        return item
+
+    def get(self):
+        with self.lock:
+            while not self.heap:
+                self.not_empty.wait()
+            return self.pop()
+
+    def get_nowait(self):
+        with self.lock:
+            if not self.heap:
+                raise queue.Empty
+            return self.pop()
+
+    def task_done(self):
+        with self.lock:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.all_done.notify_all()
+
+    def join(self):
+        with self.lock:
+            while self.unfinished > 0:
+                self.all_done.wait()
+
+# 送信先1つ分の送信スレッド
+# ポーリングとは別のスレッドで自分のキューを優先度順に処理するので、
+# 遅い送信先が他の送信先やポーリングを止めることはない（同じ優先度の中では届いた順に送る）
+class SinkWorker:
+    # max_batchが2以上のときは、handlerにキューに溜まっていた分をまとめたリストを渡す
+    # waitを渡すと、まとめる前に呼ばれる（レート制限の解除待ちなど）
+    # batch_limitを渡すと、まとめる件数をmax_batchまでのその時々の値にする
+    # summarizeはcollapseのときに「+N件」を送るための要素を作る関数
+    def __init__(self, name, handler, maxsize=SINK_QUEUE_SIZE, max_batch=1, wait=None,
+                 overflow_policy='drop_oldest', summarize=None, batch_limit=None):
+        self.name = name
+        self.handler = handler
+        self.max_batch = max_batch
+        self.wait = wait
+        self.batch_limit = batch_limit
+        self.queue = DeliveryQueue(name, maxsize, overflow_policy, summarize)
+        self.dropped = 0
+        self.thread = None
+        metrics.gauge('commentrelay_sink_queue_depth', self.queue.qsize, sink=self.name.lower())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"sink-{self.name}", daemon=True)
+        self.thread.start()
+
+    # キューがあふれたらポーリングを待たせずにoverflow_policyに従って捨てる
+    def put(self, item, priority=PRIORITY_NORMAL):
+        if self.queue.put(item, priority):
+            return True
+        self.dropped += 1
+        metrics.inc('commentrelay_dropped_total', sink=self.name.lower(), policy=self.queue.policy)
+        if self.dropped == 1 or self.dropped % 100 == 0:
+            logger.warning("%sの送信キューが満杯のためコメントを破棄しました（累計%d件）", self.name, self.dropped)
+        return False
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if self.max_batch > 1 and item is not None:
+                self.run_batch(item)
+                continue
+            try:
+                if item is None:
+                    return
+                start = time.perf_counter()
+                self.handler(*item)
+                metrics.observe('commentrelay_sink_send_seconds', time.perf_counter() - start, sink=self.name.lower())
+            except Exception as e:
+                logger.error("%sへの送信でエラーが発生しました: %s", self.name, e)
+            finally:
+                self.queue.task_done()
+
+    def run_batch(self, item):
+        if self.wait is not None:
+            self.wait()
+        limit = self.max_batch if self.batch_limit is None else min(self.batch_limit(), self.max_batch)
+        items = [item]
+        stopping = False
+        while len(items) < limit:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            items.append(item)
+        try:
+            start = time.perf_counter()
+            self.handler(items)
+            metrics.observe('commentrelay_sink_send_seconds', time.perf_counter() - start, sink=self.name.lower())
+        except Exception as e:
+            logger.error("%sへの送信でエラーが発生しました: %s", self.name, e)
+        finally:
+            for _ in range(len(items) + stopping):
+                self.queue.task_done()
+        # 停止の合図を取り出してしまった場合は戻しておく
+        if stopping:
+            self.queue.put_stop()
+
+    # 止まったままの送信先があっても終了処理が固まらないよう待ち時間に上限を設ける
+    def stop(self, timeout=5):
+        self.queue.put_stop()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+# 送信先ごとの送信プロセス（sink_isolationがprocessのとき）
+# キューと整形はこのプロセスに置いたまま、送信だけを子プロセスに任せる。送信スレッドは溜まっていた分を
+# 1つのまとまりにしてPipeで渡し、子プロセスが送り終えた返事を待つ。子プロセスは時間のかかる処理の前に
+# その最長の時間を知らせてくるので、そこからsink_process_timeout秒過ぎても返事が無ければ
+# 子プロセスを止まったものとして作り直し、同じまとまりを送り直す
+# （キューに溜まっているコメントはこちらにあるので、子プロセスを作り直しても失われない）
+SINK_ISOLATION_MODES = ('thread', 'process')
+SINK_PROCESS_MAX_ATTEMPTS = 5    # 1つのまとまりを送り直す回数の上限
+SINK_PROCESS_STOP_TIMEOUT = 2    # 止めるときに子プロセスの終了を待つ時間（秒）
+
+# Windowsでもそれ以外でも同じ起動方法にする（forkだとスレッドやロックの状態まで子プロセスに写ってしまう）
+sink_process_context = multiprocessing.get_context('spawn')
+
+if SINK_ISOLATION not in SINK_ISOLATION_MODES:
+    logger.warning("sink_isolationが不正です: %s。threadを使います。", SINK_ISOLATION)
+    SINK_ISOLATION = 'thread'
+
+class SinkProcess:
+    def __init__(self, name, sink_type, settings):
+        self.name = name
+        self.type = sink_type
+        self.settings = settings
+        self.process = None
+        self.conn = None
+        self.sequence = 0
+        self.restarts = 0
+        self.stale = False
+        self.resume_at = 0.0
+        self.congested = False
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.conn, child_conn = sink_process_context.Pipe()
+        self.process = sink_process_context.Process(
+            target=run_sink_process, args=(child_conn, self.type, self.settings, LOG_LEVEL),
+            name=f"sink-{self.name}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.stale = False
+        self.stopped = False
+
+    # 送り終えるのを待たずに止める（止まったままの子プロセス用）
+    def kill(self):
+        if self.process is None:
             return
+        self.conn.close()
+        self.process.kill()
+        self.process.join(SINK_PROCESS_STOP_TIMEOUT)
+        self.process = None
 
-        # カスタムフォーマットを適用（デフォルトフォーマットも設定）
-        custom_format = config.get('custom_format', "<{display_name}>: {message}")  # 色も指定できるように追加
+    def restart(self, reason):
+        self.restarts += 1
+        metrics.inc('commentrelay_sink_restarts_total', sink=self.name.lower())
+        logger.warning("%sの送信プロセスを作り直します: %s", self.name, reason)
+        self.kill()
+        # 終了処理で止められた場合は作り直さない
+        if not self.stopped:
+            self.start()
 
-        # 色のデフォルト値
-        color = config.get('message_color', 'yellow')  # デフォルト色を'黄色'に設定
+    # 接続先が変わったら、次に送るときに子プロセスを作り直す（設定の再読み込みから呼ばれる）
+    def configure(self, settings):
+        self.settings = settings
+        self.stale = True
 
-        # フォーマットを使用してメッセージを作成
+    # 送信スレッドから呼ばれる。子プロセスが送り終えたらTrueを返す
+    def send(self, messages):
+        with self.lock:
+            if self.stale:
+                self.stop()
+                self.start()
+            for attempt in range(SINK_PROCESS_MAX_ATTEMPTS):
+                if self.stopped:
+                    return False
+                self.sequence += 1
+                try:
+                    self.conn.send((self.sequence, messages))
+                    reason = self.wait_done()
+                    if reason is None:
+                        return True
+                except (OSError, EOFError):
+                    reason = f"送信プロセスが終了しました（終了コード: {self.process.exitcode}）"
+                self.restart(reason)
+            metrics.inc('commentrelay_dropped_total', sink=self.name.lower(), policy='hung')
+            logger.error("%sの送信プロセスが%d回続けて止まったため、%d件のコメントを破棄しました",
+                         self.name, SINK_PROCESS_MAX_ATTEMPTS, len(messages))
+            return False
+
+    # 子プロセスが送り終えるのを待つ。送り終えたらNone、止まっているとみなしたらその理由を返す
+    def wait_done(self):
+        deadline = time.monotonic() + SINK_PROCESS_TIMEOUT
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not self.conn.poll(timeout):
+                return f"{SINK_PROCESS_TIMEOUT}秒以上応答がありませんでした"
+            reply = self.conn.recv()
+            if reply[0] == 'progress':
+                # 子プロセスはこれから最長reply[1]秒かかる処理をするので、その分だけ待ち時間を延ばす
+                deadline = time.monotonic() + reply[1] + SINK_PROCESS_TIMEOUT
+                continue
+            _, sequence, pause, congested = reply
+            if sequence != self.sequence:
+                return "送信プロセスの返事が食い違っています"
+            self.resume_at = time.monotonic() + pause
+            self.congested = congested
+            return None
+
+    # 送信スレッドがまとまりを作る前に呼ばれる（子プロセスのレート制限が解除されるまで待つ）
+    def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def stop(self):
+        self.stopped = True
+        if self.process is None:
+            return
         try:
-            # フォーマットを適用
-            final_message = custom_format.format(
-                display_name=display_name,
-                message=text_cleaned,
-                timestamp=timestamp,
-                color=color  # 色をフォーマットに追加
-            )
-        except KeyError as e:
-            print(f"フォーマット文字列にキーが不足しています: {e}. デフォルトフォーマットに戻します。")
-            final_message = f"<{display_name}> {text_cleaned} ({color})"
-        except ValueError as e:
-            print(f"無効なフォーマットです: {e}. デフォルトフォーマットに戻します。")
-            final_message = f"<{display_name}> {text_cleaned} ({color})"
-
-        # tellrawコマンドを生成（色を適用）
-        tellraw_command = f'tellraw @a {{"text":"{final_message}","color":"{color}"}}'
-        print(f"tellrawコマンドを実行中: {tellraw_command}")
-
-        # RCONを使ってコマンドを送信
-        with MCRcon(MINECRAFT_RCON_HOST, MINECRAFT_RCON_PASSWORD, port=MINECRAFT_RCON_PORT) as mcr:
-            response = mcr.command(tellraw_command)
-            print(f"RCONのレスポンス: {response}")
-
-        if text_cleaned.strip():  # メッセージが空でない場合にのみ表示
-            print(f"Minecraftに送信しました: {final_message}")
-    except Exception as e:
-        print(f"Minecraftへの送信でエラーが発生しました: {e}")
-
-
-# 古いコメントを削除
-        remove_expired_comments()
-
-# 初コメント判定用の辞書
-live_comments_tracker = {}
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(SINK_PROCESS_STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(SINK_PROCESS_STOP_TIMEOUT)
+        self.conn.close()
+        self.process = None
+
+# collapseで省略したコメントの代わりに送るメッセージ
+COLLAPSED_DISPLAY_NAME = 'CommentRelay'
+
+def collapsed_comment(count):
+    return CleanComment(COLLAPSED_DISPLAY_NAME, f"+{count}件のコメント（混雑のため省略しました）", '', '')
+
+# 中継の経路
+# sourcesにコメントの取得元（ワンコメ）、sinksに送信先（DiscordのWebhookやMinecraftサーバー）を並べ、
+# routesでどの取得元のコメントをどの送信先に送るかを決める。全部を1つのプロセスで受け持ち、
+# ポーリングのスケジューラー・接続プール・処理済みコメントは共有する。
+# 3つとも空なら従来の設定（api_endpoint / discord_webhook_url / minecraft_rcon_*）から1組だけ作る
+SINK_TYPES = ('discord', 'minecraft')
+DEFAULT_SOURCE_NAME = 'default'
+
+def routing_settings(config):
+    sources = config.get('sources') or [{
+        'name': DEFAULT_SOURCE_NAME,
+        'api_endpoint': config['api_endpoint'],
+        'comment_stream_endpoint': config['comment_stream_endpoint'],
+    }]
+    sinks = config.get('sinks') or [
+        {'name': 'discord', 'type': 'discord'},
+        {'name': 'minecraft', 'type': 'minecraft'},
+    ]
+    # routesが無ければ全ての取得元から全ての送信先に送る
+    routes = config.get('routes') or [
+        {'source': source.get('name'), 'sinks': [sink.get('name') for sink in sinks]} for source in sources
+    ]
+    return sources, sinks, routes
+
+# 整数の設定値を確かめる（"200"のような数字の文字列も受け付ける）
+def config_int(value, label, minimum, maximum=None):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{label}は整数にしてください: {value!r}")
+    if number < minimum or (maximum is not None and number > maximum):
+        raise ValueError(f"{label}の値が範囲外です: {value!r}")
+    return number
+
+# 経路の設定を確かめ、省略された項目をコンフィグの値で補う
+# (取得元名 -> 設定, 送信先名 -> 設定, 取得元名 -> 送信先名のリスト)を返し、間違いがあればValueErrorにする
+def load_routing(config):
+    for key in ('sources', 'sinks', 'routes'):
+        items = config.get(key) or []
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError(f"{key}は項目（{{...}}）のリストにしてください。")
+    sources, sinks, routes = routing_settings(config)
+
+    source_settings = {}
+    for source in sources:
+        name = source.get('name')
+        if not name or name in source_settings:
+            raise ValueError(f"sourcesの名前が空か重複しています: {name}")
+        if not source.get('api_endpoint'):
+            raise ValueError(f"source「{name}」にapi_endpointがありません。")
+        source_settings[name] = dict({'comment_stream_endpoint': ''}, **source)
+
+    sink_settings = {}
+    for sink in sinks:
+        name = sink.get('name')
+        if not name or name in sink_settings:
+            raise ValueError(f"sinksの名前が空か重複しています: {name}")
+        if sink.get('type') == 'discord':
+            defaults = {
+                'webhook_url': config['discord_webhook_url'],
+                'queue_size': config['discord_queue_size'],
+                'overflow_policy': config['discord_overflow_policy'],
+            }
+        elif sink.get('type') == 'minecraft':
+            defaults = {
+                'host': config['minecraft_rcon_host'],
+                'port': config['minecraft_rcon_port'],
+                'password': config['minecraft_rcon_password'],
+                'custom_format': config['custom_format'],
+                'message_color': config['message_color'],
+                'queue_size': config['minecraft_queue_size'],
+                'overflow_policy': config['minecraft_overflow_policy'],
+            }
+        else:
+            raise ValueError(f"sink「{name}」のtypeが不明です（{' / '.join(SINK_TYPES)}のどれかにしてください）: {sink.get('type')}")
+        settings = sink_settings[name] = dict(defaults, **sink)
+        settings['queue_size'] = config_int(settings['queue_size'], f"sink「{name}」のqueue_size", 1)
+        if settings['overflow_policy'] not in OVERFLOW_POLICIES:
+            raise ValueError(f"sink「{name}」のoverflow_policyが不明です（{' / '.join(OVERFLOW_POLICIES)}のどれかにしてください）: "
+                             f"{settings['overflow_policy']}")
+        if 'port' in settings:
+            settings['port'] = config_int(settings['port'], f"sink「{name}」のport", 1, 65535)
+
+    route_map = {name: [] for name in source_settings}
+    for route in routes:
+        source = route.get('source')
+        if source not in route_map:
+            raise ValueError(f"routesの取得元がsourcesにありません: {source}")
+        sinks = route.get('sinks', [])
+        if not isinstance(sinks, list):
+            raise ValueError(f"routesの送信先はリストにしてください: {sinks!r}")
+        for sink in sinks:
+            if sink not in sink_settings:
+                raise ValueError(f"routesの送信先がsinksにありません: {sink}")
+            if sink not in route_map[source]:
+                route_map[source].append(sink)
+    return source_settings, sink_settings, route_map
+
+# 送信先1つ分。種類に応じた整形と送信処理を持ち、送信スレッドで送る
+class RelaySink:
+    # templatesは同じフォーマットの送信先どうしでMessageTemplateを共有するための辞書
+    def __init__(self, name, settings, templates):
+        self.name = name
+        self.settings = settings
+        self.type = settings['type']
+        # processのときは送信を子プロセスに任せる
+        self.process = SinkProcess(name, self.type, settings) if SINK_ISOLATION == 'process' else None
+        if self.type == 'discord':
+            # 既定のWebhookは起動時の確認と同じ接続を使う。レート制限はWebhookごとに数える
+            url = settings['webhook_url']
+            self.sender = discord_sender if url == discord_sender.webhook_url else DiscordSender(url)
+            self.render_key = 'discord'
+            self.worker = SinkWorker(
+                name, self.send, maxsize=settings['queue_size'], max_batch=DISCORD_MAX_EMBEDS,
+                wait=self.sender.wait_for_bucket if self.process is None else self.process.wait,
+                batch_limit=self.discord_batch_limit, overflow_policy=settings['overflow_policy'],
+                summarize=lambda count: discord_message(collapsed_comment(count)))
+        else:
+            self.server = (settings['host'], settings['port'], settings['password'])
+            self.template = self.render_key = self.template_for(settings, templates)
+            self.worker = SinkWorker(
+                name, self.send, maxsize=settings['queue_size'], max_batch=MINECRAFT_MAX_BATCH,
+                overflow_policy=settings['overflow_policy'],
+                summarize=lambda count: minecraft_message(collapsed_comment(count), self.template))
+
+    @staticmethod
+    def template_for(settings, templates):
+        key = (settings['custom_format'], settings['message_color'])
+        if key == (message_template.custom_format, message_template.color):
+            templates.setdefault(key, message_template)
+        return templates.get(key) or templates.setdefault(key, MessageTemplate(*key))
+
+    # 設定の再読み込みで変わった部分だけを作り直す。送信スレッドとキューに溜まっているコメントはそのまま
+    # （溜まっているコメントは前のフォーマットで整形済みなので、そのまま送る）
+    def update(self, settings, templates):
+        old, self.settings = self.settings, settings
+        if self.type == 'discord':
+            if settings['webhook_url'] != old['webhook_url']:
+                self.sender = DiscordSender(settings['webhook_url'])
+                if self.process is None:
+                    self.worker.wait = self.sender.wait_for_bucket
+                else:
+                    self.process.configure(settings)
+        else:
+            server = (settings['host'], settings['port'], settings['password'])
+            if server != self.server:
+                if self.process is not None:
+                    self.process.configure(settings)
+                self.server = server
+            self.template = self.render_key = self.template_for(settings, templates)
+        self.worker.queue.configure(settings['queue_size'], settings['overflow_policy'])
+
+    # 送信プロセスで送るときは、子プロセスから伝えられた制限の状態で決める
+    def discord_batch_limit(self):
+        congested = self.sender.congested if self.process is None else self.process.congested
+        return DISCORD_MAX_EMBEDS if congested else 1
+
+    # 整形済みのコメントからこの送信先に送る形を作る
+    def render(self, comment):
+        if self.type == 'discord':
+            return discord_message(comment)
+        return minecraft_message(comment, self.template)
+
+    def start(self):
+        if self.process is not None:
+            self.process.start()
+        self.worker.start()
+
+    # 溜まっている分を送り終えてから止める
+    def stop(self):
+        self.worker.stop()
+        if self.process is not None:
+            self.process.stop()
+
+    def send(self, messages):
+        if self.process is not None:
+            self.process.send(messages)
+        elif self.type == 'discord':
+            send_discord_batch(messages, self.sender)
+        else:
+            send_minecraft_batch(messages, self.server)
+
+# 送信先名 -> RelaySink、取得元名 -> その取得元のコメントを送るRelaySinkのリスト
+# 送信先名 -> その送信先への経路がある取得元名のリスト
+relay_sinks = {}
+relay_routes = {}
+relay_sink_sources = {}
+
+def start_sinks(sink_settings, routes):
+    update_sinks(sink_settings, routes)
+    catchup_pacer.start()
+
+# 送信先を設定に合わせる。増えたものは作って動かし、設定が変わったものはその部分だけを作り直す
+# 経路から外れた送信先を返すので、comments_lockを放してから止めること
+def update_sinks(sink_settings, routes):
+    templates = {(sink.template.custom_format, sink.template.color): sink.template
+                 for sink in relay_sinks.values() if sink.type == 'minecraft'}
+    removed = [relay_sinks.pop(name) for name in list(relay_sinks) if name not in sink_settings]
+    for name, settings in sink_settings.items():
+        sink = relay_sinks.get(name)
+        if sink is not None and sink.type == settings['type']:
+            if sink.settings != settings:
+                logger.info("送信先「%s」の設定を反映しました。", name)
+                sink.update(settings, templates)
+            continue
+        if sink is not None:
+            removed.append(sink)
+        sink = RelaySink(name, settings, templates)
+        relay_sinks[name] = sink
+        sink.start()
+    # 経路は作り直したものと丸ごと入れ替える
+    relay_routes.clear()
+    relay_sink_sources.clear()
+    for source, names in routes.items():
+        relay_routes[source] = [relay_sinks[name] for name in names]
+        for name in names:
+            relay_sink_sources.setdefault(name, []).append(source)
+    return removed
+
+def stop_sinks():
+    catchup_pacer.stop()
+    for sink in relay_sinks.values():
+        sink.stop()
+    relay_sinks.clear()
+    relay_routes.clear()
+    relay_sink_sources.clear()
+    reward_outbox.stop()
+    rcon_pool.close()
+
+# 処理済みコメントの記録のキー。取得元ごとに記録し、同じコメントが複数の取得元に届いても
+# どちらが先にポーリングしたかによらず、それぞれの経路の送信先に送れるようにする
+# （既定の取得元はこれまでの記録と同じくコメントIDのままにする）
+def processed_key(source, comment_id):
+    return comment_id if source == DEFAULT_SOURCE_NAME else f'{source}\t{comment_id}'
+
+# 複数の取得元から経路がある送信先のうち、同じコメントを別の取得元で処理済み（送信済み）のものの名前
+def already_delivered(source, comment_id, sinks):
+    delivered = set()
+    for sink in sinks:
+        sources = relay_sink_sources.get(sink.name, ())
+        if len(sources) < 2:
+            continue
+        if any(other != source and processed_key(other, comment_id) in processed_comments for other in sources):
+            delivered.add(sink.name)
+    return delivered
+
+# 整形済みのコメントを送信先ごとの形にしてキューに入れる
+# 同じ形の送信先（同じフォーマットのMinecraftサーバーなど）には1回作ったものを送る
+def deliver_comment(sinks, cleaned, priority):
+    rendered = {}
+    for sink in sinks:
+        message = rendered.get(sink.render_key)
+        if message is None:
+            message = rendered[sink.render_key] = sink.render(cleaned)
+        sink.worker.put(message, priority)
+
+def catchup_summary_comment(count):
+    return CleanComment(COLLAPSED_DISPLAY_NAME, f"停止中に届いていたコメント{count}件は省略しました", '', '')
+
+# 再起動や通信断のあとに溜まっていたコメントを、決まった速さで送信先のキューに入れる
+# 一度に流すとMinecraftのチャットが埋まり、Discordのレート制限にもかかるため。
+# 新しく届いたコメントはこれを待たずにすぐ送る
+class CatchUpPacer:
+    def __init__(self, rate):
+        self.rate = rate
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        metrics.gauge('commentrelay_catchup_pending', lambda: len(self.pending))
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="catchup", daemon=True)
+        self.thread.start()
+
+    # 送り先はキューから出すときに経路から決める（その間に設定が変わってもよいように）
+    # skippedは別の取得元から既に送った送信先の名前
+    def put(self, source, cleaned, priority, skipped=()):
+        with self.condition:
+            self.pending.append((source, cleaned, priority, skipped))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                source, cleaned, priority, skipped = self.pending.popleft()
+            with comments_lock:
+                sinks = [sink for sink in relay_routes.get(source, []) if sink.name not in skipped]
+                deliver_comment(sinks, cleaned, priority)
+            if self.rate > 0:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.stopped, 1 / self.rate)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if self.pending:
+            logger.warning("溜まっていたコメントのうち%d件は送らずに終了しました。", len(self.pending))
+            self.pending.clear()
+
+catchup_pacer = CatchUpPacer(CATCHUP_RATE)
 
 def remove_expired_comments():
-    current_time = datetime.now(timezone.utc)
-    expiry_time = current_time - timedelta(days=COMMENT_EXPIRY_DAYS)
-    expired_keys = [key for key, (timestamp, live_id) in processed_comments.items()
-                    if datetime.fromisoformat(timestamp) < expiry_time]
-    for key in expired_keys:
-        del processed_comments[key]
+    expiry_time = time.time() - timedelta(days=COMMENT_EXPIRY_DAYS).total_seconds()
+    processed_comments.expire(expiry_time)
+    live_comments_tracker.expire(expiry_time)
 
-def fetch_comments(api_endpoint):
-    global processed_comments, live_comments_tracker
+# ポーリングとWebSocketの両方から呼ばれるので、同時に処理しないようにする
+comments_lock = threading.Lock()
+
+# ワンコメの応答の読み込み
+# ワンコメは配信中のコメントを古い順に全部返すので、配信が長くなるほど応答が大きくなる。
+# 前回の応答の最後のコメントID（high-water mark）を覚えておき、今回の応答ではそれより後ろだけをJSONとして読む。
+# 応答は届いた分から読み進め、コメントの一覧を丸ごと作ることはしない
+RESPONSE_CHUNK_SIZE = 64 * 1024
+JSON_DECODER = json.JSONDecoder()
+JSON_SEPARATOR = re.compile(r'[ \t\n\r,]*')
+JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+JSON_STRUCTURE = re.compile(r'["{}\[\]]')
+
+# 取得元名 -> 前回の応答の最後のコメントID
+high_water_marks = {}
+
+# text[position:]にある配列の要素を読めるところまで読む。(要素のリスト, 次に読む位置)を返す
+# 要素が途中で切れていたら、finalでなければ続きが届くのを待つ
+def decode_array_items(text, position, final):
+    items = []
+    while True:
+        position = JSON_SEPARATOR.match(text, position).end()
+        if position >= len(text) and final:
+            raise ValueError("コメントの一覧が途中で終わっています")
+        if position >= len(text) or text[position] == ']':
+            return items, position
+        try:
+            item, position = JSON_DECODER.raw_decode(text, position)
+        except ValueError:
+            if final:
+                raise
+            return items, position
+        items.append(item)
+
+# コメントIDの文字列の直後から括弧の深さを数え、そのコメント（data -> 配列の要素）が閉じた位置を返す
+# 続きがまだ届いていなければNone
+def skip_comment(text, position):
+    depth = 0
+    while True:
+        match = JSON_STRUCTURE.search(text, position)
+        if match is None:
+            return None
+        char = match.group()
+        if char == '"':
+            string = JSON_STRING.match(text, match.start())
+            if string is None:
+                return None
+            position = string.end()
+            continue
+        position = match.end()
+        if char in '{[':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == -2:
+                return position
+
+# 応答のテキストを少しずつ受け取り、high-water markより後ろのコメントだけを返す
+# markerが応答に見つからない場合（ワンコメを再起動したときなど）は全部を読む
+class CommentResponseReader:
+    def __init__(self, high_water_id):
+        self.marker = json.dumps(high_water_id, ensure_ascii=False) if high_water_id else None
+        self.chunks = []       # markerを探している間に受け取ったテキスト
+        self.received = 0      # chunksの合計の長さ
+        self.tail = ''         # 受け取ったテキストの最後の部分（markerの長さ-1文字）
+        self.found = None      # markerが見つかった位置
+        self.text = ''         # 読んでいる途中のテキスト
+        self.position = None   # textの中の次に読む位置（まだ'['を読んでいなければNone）
+        self.items = []
+
+    def feed(self, chunk, final=False):
+        if self.marker is not None:
+            if not self.seek(chunk, final):
+                return
+        else:
+            self.text += chunk
+        if self.position is None:
+            start = self.text.find('[')
+            if start < 0:
+                if final:
+                    raise ValueError("コメントの一覧ではありません")
+                return
+            self.position = start + 1
+        items, position = decode_array_items(self.text, self.position, final)
+        self.items.extend(items)
+        # 読み終えた部分は捨てて、残りのテキストが大きくならないようにする
+        self.text = self.text[position:]
+        self.position = 0
+
+    # markerが見つかるまではJSONとして読まずに探すだけにする。見つかったら（または最後まで見つからなければ）
+    # 読み始める位置を決めてTrueを返す
+    def seek(self, chunk, final):
+        if self.found is None and chunk:
+            # チャンクの境目をまたいだmarkerも見つけられるように、前のチャンクの最後の部分も含めて探す
+            window = self.tail + chunk
+            found = window.find(self.marker)
+            if found >= 0:
+                self.found = self.received - len(self.tail) + found
+            self.tail = window[max(len(window) - len(self.marker) + 1, 0):]
+        if chunk:
+            self.chunks.append(chunk)
+            self.received += len(chunk)
+        if self.found is None and not final:
+            return False
+
+        text = ''.join(self.chunks)
+        end = None
+        if self.found is not None:
+            end = skip_comment(text, self.found + len(self.marker))
+            if end is None and not final:
+                # そのコメントの終わりがまだ届いていない
+                self.chunks = [text]
+                return False
+        self.marker = None
+        self.chunks = []
+        self.text = text
+        # 思っていた形でなければ（IDが別の場所に現れていたなど）最初から全部読む
+        if end is not None:
+            following = JSON_SEPARATOR.match(text, end).end()
+            if following >= len(text) or text[following] in '{]':
+                self.position = end
+        return True
+
+    def comments(self):
+        return [item for item in self.items if isinstance(item, dict) and isinstance(item.get('data'), dict)]
+
+# 応答を読み、high-water markより後ろのコメントと、今回の応答の最後のコメントIDを返す
+def read_comment_response(response, high_water_id):
+    reader = CommentResponseReader(high_water_id)
+    if response.encoding is None:
+        response.encoding = 'utf-8'
+    for chunk in response.iter_content(RESPONSE_CHUNK_SIZE, decode_unicode=True):
+        reader.feed(chunk)
+    reader.feed('', final=True)
+    comments = reader.comments()
+    last_id = comments[-1]['data'].get('id') if comments else high_water_id
+    return comments, last_id
+
+# 新しく処理したコメント数を返す（取得に失敗した場合はNone）
+def fetch_comments(api_endpoint, source=DEFAULT_SOURCE_NAME):
     try:
-        response = requests.get(api_endpoint)
-        response.raise_for_status()
-        comments = response.json()
-        current_time = datetime.now(timezone.utc)
-
-        new_comments = [
-            comment for comment in comments
-            if comment['data']['id'] not in processed_comments and
-               datetime.fromisoformat(comment['data']['timestamp']) > current_time - timedelta(minutes=60)
-        ]
-
-        for comment in new_comments:
-            display_name = comment['data']['displayName']
-            text = comment['data']['comment']
-            comment_id = comment['data']['id']
-            original_profile_image_url = comment['data'].get('originalProfileImage', '')
-
-            # 1.2時点で追加
-            live_id = comment['data']['liveId']
-            user_id = comment['data']['userId']
-            
-            # 初コメント判定
-            is_first_time = False
-            # live_idが新しい場合、またはその配信枠でまだコメントされていない場合
-            if live_id not in live_comments_tracker:
-                live_comments_tracker[live_id] = set()  # 新しい枠を初期化
-                is_first_time = True
-            # ユーザーIDがその配信枠で初めての場合
-            elif user_id not in live_comments_tracker[live_id]:
-                is_first_time = True
+        start = time.perf_counter()
+        with requests.get(api_endpoint, timeout=HTTP_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            comments, last_id = read_comment_response(response, high_water_marks.get(source))
+    except (requests.RequestException, ValueError) as e:
+        metrics.inc('commentrelay_fetch_errors_total')
+        logger.warning("Error fetching comments (%s): %s", source, e)
+        return None
+    metrics.observe('commentrelay_fetch_seconds', time.perf_counter() - start)
+    count = handle_comments(comments, source)
+    high_water_marks[source] = last_id
+    return count
+
+# 受け取ったコメントのうち未処理のものを、取得元の経路にある送信先に振り分ける
+def handle_comments(comments, source=DEFAULT_SOURCE_NAME):
+    with comments_lock:
+        start = time.perf_counter()
+        count = process_comments(comments, source)
+        metrics.observe('commentrelay_process_seconds', time.perf_counter() - start)
+        metrics.inc('commentrelay_comments_total', count)
+        return count
+
+# 新しく届いたコメントを1行に1件のJSONLで書き残す（--recordで指定したとき。--replayで再生できる）
+class CommentRecorder:
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, comments):
+        for comment in comments:
+            self.file.write(json.dumps(comment, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+comment_recorder = None
+
+# comments_lockを取った状態で呼ぶこと
+# 処理済みコメントと初コメント判定は全ての取得元で共有し、同じコメントを二重に送らない
+# 同じコメントは何度も届くので、タイムスタンプの解析結果を覚えておく
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp).timestamp()
+
+# 送信に使う項目（どれも文字列）
+COMMENT_REQUIRED_FIELDS = ('id', 'displayName', 'comment', 'liveId', 'userId', 'timestamp')
+
+# 送れるコメントなら投稿時刻(UNIX秒)を返す。項目が足りないかタイムスタンプが読めなければNone
+def comment_posted_time(data):
+    if not all(isinstance(data.get(field), str) for field in COMMENT_REQUIRED_FIELDS):
+        return None
+    try:
+        return parse_timestamp(data['timestamp'])
+    except ValueError:
+        return None
+
+def process_comments(comments, source=DEFAULT_SOURCE_NAME):
+    global processed_comments, live_comments_tracker
+    current_time = datetime.now(timezone.utc)
+    sinks = relay_routes.get(source, [])
+
+    # catchup_window_minutesより前のコメントは、再起動しても送り直さない
+    # ワンコメは古い順に返すので、新しい方から見て処理済みのコメントか期間外のコメントに当たったら、それより前は見ない
+    window_start = current_time.timestamp() - CATCHUP_WINDOW_MINUTES * 60
+    new_comments = []
+    for comment in reversed(comments):
+        data = comment.get('data')
+        if not isinstance(data, dict) or not isinstance(data.get('id'), str):
+            logger.warning("IDの無いコメントを読み飛ばしました（%s）: %s", source, comment)
+            continue
+        key = processed_key(source, data['id'])
+        if key in processed_comments:
+            break
+        posted = comment_posted_time(data)
+        if posted is None:
+            # 1件の壊れたコメントで取得元全体を止めないよう、処理済みとして記録して読み飛ばす
+            logger.warning("項目が足りないかタイムスタンプが読めないコメントを読み飛ばしました（%s）: %s", source, data['id'])
+            processed_comments.add(key, current_time.timestamp(), None)
+            continue
+        if posted <= window_start:
+            break
+        new_comments.append((comment, posted))
+    new_comments.reverse()
+    if comment_recorder is not None and new_comments:
+        comment_recorder.write(comment for comment, posted in new_comments)
+
+    # catchup_after_secondsより前に投稿されていたものは、停止中や通信断の間に溜まっていたコメント
+    catchup_start = current_time.timestamp() - CATCHUP_AFTER_SECONDS
+    caught_up = 0
+    summarized = 0
+
+    for comment, posted in new_comments:
+        display_name = comment['data']['displayName']
+        text = comment['data']['comment']
+        comment_id = comment['data']['id']
+        original_profile_image_url = comment['data'].get('originalProfileImage', '')
 
-            # デバッグ: コメント内容の確認
-            print(f"DEBUG: Received comment text: {text}")
+        # 1.2時点で追加
+        live_id = comment['data']['liveId']
+        user_id = comment['data']['userId']
+        
+        # 初コメント判定
+        # live_idが新しい場合、またはユーザーIDがその配信枠で初めての場合
+        is_first_time = live_comments_tracker.is_first_time(live_id, user_id, current_time.timestamp())
+
+        # デバッグ: コメント内容の確認
+        logger.debug("Received comment text: %s", text)
 
-            # 既に送信されたコメントでない場合のみ送信
-            if comment_id not in processed_comments:
-                send_to_discord(display_name, text, original_profile_image_url)
-                send_to_minecraft(text, comment['data']['timestamp'], display_name)
+        # 既に送信されたコメントでない場合のみ送信
+        # 送信は各送信先のスレッドに任せ、ここではキューに積むだけにする
+        key = processed_key(source, comment_id)
+        if key not in processed_comments:
+            # HTMLの後始末は1回だけ行い、各送信先の形はその結果から作る（空のメッセージは送らない）
+            cleaned = clean_comment(display_name, text, comment['data']['timestamp'], original_profile_image_url)
+            if cleaned is not None:
+                # 有料メッセージ・メンバーシップ・初コメントは通常のコメントより先に送る
+                priority = comment_priority(comment['data'], is_first_time)
+                # 同じコメントを別の取得元から受け取って送った送信先には送らない
+                skipped = already_delivered(source, comment_id, sinks)
+                if posted >= catchup_start:
+                    deliver_comment([sink for sink in sinks if sink.name not in skipped] if skipped else sinks,
+                                    cleaned, priority)
+                elif CATCHUP_SUMMARY and priority >= PRIORITY_FIRST_TIME:
+                    # 有料メッセージとメンバーシップ以外は件数だけにする（初コメントの報酬は送る）
+                    summarized += 1
+                else:
+                    catchup_pacer.put(source, cleaned, priority, skipped)
+                    caught_up += 1
 
-                # コメントIDをキーとしてタイムスタンプとlive_idを保存
-                processed_comments[comment_id] = [current_time.isoformat(), live_id]
+            # 取得元とコメントIDをキーとしてタイムスタンプとlive_idを保存
+            processed_comments.add(key, current_time.timestamp(), live_id)
 
-                # 初めてのコメント判定を行い、必要なら報酬APIを送信
-                if is_first_time:
-                    # live_comments_tracker にコメントIDを追加して初コメントとして処理
-                    live_comments_tracker[live_id].add(user_id)
-                    send_reward_api(user_id, live_id, is_first_time)
+            # 初めてのコメント判定を行い、必要なら報酬APIを送信（送信箱に入れて別スレッドで送る）
+            if is_first_time:
+                # live_comments_tracker にコメントIDを追加して初コメントとして処理
+                live_comments_tracker.add(live_id, user_id)
+                reward_outbox.put(user_id, live_id)
 
-        remove_expired_comments()
+    if summarized:
+        deliver_comment(sinks, catchup_summary_comment(summarized), PRIORITY_NORMAL)
+    if caught_up or summarized:
+        metrics.inc('commentrelay_catchup_total', caught_up + summarized, source=source)
+        logger.info("溜まっていたコメントがあります（%s）: %d件は少しずつ送り、%d件は件数だけ送ります。",
+                    source, caught_up, summarized)
 
-        # 処理したコメントを保存
-        with open(processed_comments_file, 'w', encoding='utf-8') as file:
-            json.dump(processed_comments, file, ensure_ascii=False, indent=4)
+    remove_expired_comments()
 
-    except requests.RequestException as e:
-        print(f"Error fetching comments: {e}")
+    # 処理したコメントを保存（今回増えた分と期限切れで消えた分だけ）
+    processed_comments.flush()
+    return len(new_comments)
 
 
 # Discord Webhookの確認
-def check_discord_webhook():
+def check_discord_webhook(url=None):
     try:
-        response = requests.get(DISCORD_WEBHOOK_URL)
+        response = requests.get(url or DISCORD_WEBHOOK_URL, timeout=HTTP_TIMEOUT)
         return response.status_code == 200
     except requests.RequestException:
         return False
 
+# 起動時の確認の設定
+startup_cache_file = 'startup_cache.json'
+STARTUP_CHECK_TIMEOUT = 5                 # この秒数で終わらない確認は待たずに中継を続ける
+WEBHOOK_CHECK_CACHE_TTL = 24 * 60 * 60    # Webhookの確認結果を使い回す期間（秒）
+
+def load_startup_cache():
+    try:
+        with open(startup_cache_file, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+# 同じURLを最近確認できていれば、起動のたびにDiscordへ問い合わせない
+# キャッシュにはURLごとに確認できた時刻を残す
+def check_discord_webhook_cached(url=None):
+    url = url or DISCORD_WEBHOOK_URL
+    if url == default_config['discord_webhook_url']:
+        return False
+    cache = load_startup_cache()
+    if time.time() - cache.get('discord_webhooks', {}).get(url, 0) < WEBHOOK_CHECK_CACHE_TTL:
+        return True
+
+    valid = check_discord_webhook(url)
+    if valid:
+        cache.setdefault('discord_webhooks', {})[url] = time.time()
+        write_json_atomic(startup_cache_file, cache)
+    return valid
+
+# Discordの送信先すべてのWebhookを確認し、無効だった送信先の名前を返す
+def check_discord_webhooks(sink_settings):
+    return [name for name, settings in sink_settings.items()
+            if settings['type'] == 'discord' and not check_discord_webhook_cached(settings['webhook_url'])]
+
+# 起動時のネットワーク確認（Webhookの確認とAPIキーの取得）
+# 並行して裏で行い、終わるのを待たずに中継を始める。結果はメインループからpoll()で受け取る
+class StartupChecks:
+    def __init__(self, sink_settings):
+        self.sink_settings = sink_settings
+        self.started = None
+        self.webhook = None
+        self.invalid_webhooks = []
+
+    def start(self):
+        self.started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup")
+        self.webhook = executor.submit(check_discord_webhooks, self.sink_settings)
+        executor.shutdown(wait=False)
+        # APIキーの確認は送信箱のスレッドが行い、取得できるまでやり直す（それまで報酬は送信箱に溜めておく）
+        reward_outbox.start()
+
+    # 終わった確認の結果を反映する。Webhookが無効と分かったらFalseを返す
+    def poll(self):
+        if self.webhook is not None:
+            if self.webhook.done():
+                future, self.webhook = self.webhook, None
+                self.invalid_webhooks = future.result()
+                if self.invalid_webhooks:
+                    return False
+            elif time.monotonic() - self.started > STARTUP_CHECK_TIMEOUT:
+                logger.warning("Discord Webhookの確認が%d秒以内に終わらないため、確認を待たずに続けます。", STARTUP_CHECK_TIMEOUT)
+                self.webhook = None
+        return True
+
+# 設定エラーを知らせる（ヘッドレスではログに出すだけで、tkinterは読み込まない）
+def show_config_error(message, headless):
+    logger.error(message)
+    if headless:
+        return
+    import tkinter as tk
+    from tkinter import messagebox
+    root = tk.Tk()
+    root.withdraw()
+    messagebox.showwarning("設定エラー", message)
+
+# WebSocketの設定
+COMMENT_STREAM_PING_INTERVAL = 30        # この秒数何も届かなければpingで生存確認する
+COMMENT_STREAM_RECONNECT_BASE_DELAY = 1  # 再接続バックオフの初期値（秒）
+COMMENT_STREAM_RECONNECT_MAX_DELAY = 30  # 再接続バックオフの上限（秒）
+
+# APIのURL(http://host:port/api/comments)からワンコメのWebSocketのURL(ws://host:port/sub)を作る
+def comment_stream_url(api_endpoint, stream_endpoint=''):
+    if stream_endpoint:
+        return stream_endpoint
+    parts = urlsplit(api_endpoint)
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    return urlunsplit((scheme, parts.netloc, '/sub', '', ''))
+
+# ワンコメのWebSocketからコメントを受け取るクラス
+# 届いたコメントはすぐにhandle_commentsへ渡す。切断されたらバックオフしながら再接続する
+class CommentStream:
+    def __init__(self, url, on_comments, name=DEFAULT_SOURCE_NAME):
+        self.url = url
+        self.name = name
+        self.on_comments = on_comments
+        self.connected = threading.Event()
+        self.disconnected = threading.Event()
+        self.disconnected.set()
+        self.stopped = False
+        self.ws = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"comment-stream-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.ws is not None:
+            self.ws.close()
+
+    def run(self):
+        delay = COMMENT_STREAM_RECONNECT_BASE_DELAY
+        while not self.stopped:
+            try:
+                self.ws = websocket.create_connection(self.url, timeout=COMMENT_STREAM_PING_INTERVAL)
+                logger.info("ワンコメのWebSocketに接続しました: %s", self.url)
+                self.disconnected.clear()
+                self.connected.set()
+                delay = COMMENT_STREAM_RECONNECT_BASE_DELAY
+                self.receive()
+            except Exception as e:
+                if not self.stopped:
+                    logger.warning("ワンコメのWebSocketが切断されました: %s", e)
+            finally:
+                self.connected.clear()
+                self.disconnected.set()
+                if self.ws is not None:
+                    self.ws.close()
+                    self.ws = None
+            if not self.stopped:
+                time.sleep(delay)
+                delay = min(delay * 2, COMMENT_STREAM_RECONNECT_MAX_DELAY)
+
+    def receive(self):
+        while not self.stopped:
+            try:
+                message = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                # しばらく何も届かないときは接続が生きているか確認する
+                self.ws.ping()
+                continue
+            if not message:
+                raise ConnectionError("接続が閉じられました")
+            comments = self.parse_message(message)
+            if comments:
+                self.on_comments(comments)
+
+    # 接続直後の{"type":"connected"}と新着の{"type":"comments"}にコメントの一覧が入っている
+    @staticmethod
+    def parse_message(message):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return []
+        if not isinstance(event, dict) or event.get('type') not in ('connected', 'comments'):
+            return []
+        data = event.get('data') or {}
+        comments = data.get('comments', []) if isinstance(data, dict) else data
+        return [comment for comment in comments if isinstance(comment, dict) and 'data' in comment]
+
+# ポーリング間隔の調整
+POLL_RATE_SMOOTHING = 0.3     # コメント流量の移動平均で新しい値にかける重み
+POLL_IDLE_BACKOFF = 1.5       # コメントが無かったときに間隔を延ばす倍率
+POLL_ERROR_MAX_INTERVAL = 60  # 取得に失敗し続けたときの間隔の上限（秒）
+
+# 単調増加する時計で次のポーリング時刻を決めるスケジューラー
+# 処理にかかった時間の分だけ周期がずれることがなく、間隔は秒未満でもよい。
+# コメントが多いときは最小間隔まで縮め、静かなときは最大間隔まで延ばし、
+# ワンコメからの取得に失敗したときはさらに延ばす
+class PollScheduler:
+    def __init__(self, interval, minimum, maximum):
+        self.target = interval
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.rate = 0.0  # 1秒あたりの新着コメント数（移動平均）
+        self.errors = 0
+        self.last_poll = None
+        self.deadline = time.monotonic()
+
+    # 設定の再読み込みで間隔が変わったとき（流量の移動平均はそのまま引き継ぐ）
+    def configure(self, interval, minimum, maximum):
+        self.target = interval
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = min(max(self.interval, minimum), maximum)
+        self.deadline = min(self.deadline, time.monotonic() + self.interval)
+
+    # 次のポーリング時刻まで待つ
+    def wait(self):
+        delay = self.deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    # ポーリング結果から次の間隔を決める（new_commentsがNoneなら取得失敗）
+    def record(self, new_comments):
+        now = time.monotonic()
+        if new_comments is None:
+            self.errors += 1
+            self.interval = min(max(self.interval, self.target) * 2, max(POLL_ERROR_MAX_INTERVAL, self.maximum))
+        else:
+            self.errors = 0
+            if self.last_poll is not None and now > self.last_poll:
+                sample = new_comments / (now - self.last_poll)
+                self.rate = POLL_RATE_SMOOTHING * sample + (1 - POLL_RATE_SMOOTHING) * self.rate
+            if new_comments:
+                # 1回のポーリングで1件程度になる間隔まで縮める（目標間隔より長くはしない）
+                self.interval = min(max(1 / self.rate, self.minimum), self.target) if self.rate else self.target
+            else:
+                self.interval = min(self.interval * POLL_IDLE_BACKOFF, self.maximum)
+        self.last_poll = now
+
+        # 前回の予定時刻を基準に次の予定を決め、処理が長引いて過ぎていれば今から数える
+        self.deadline = max(self.deadline + self.interval, now)
+        return self.interval
+
+# コメントの取得元1つ分（ワンコメ1台）。WebSocketとポーリングの状態を持つ
+class CommentSource:
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.api_endpoint = settings['api_endpoint']
+        self.stream_url = comment_stream_url(self.api_endpoint, settings['comment_stream_endpoint'])
+        self.scheduler = PollScheduler(POLL_INTERVAL, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX)
+        self.stream = None
+        self.fetching = None  # 取得中のFuture
+
+    def start_stream(self):
+        self.stream = CommentStream(self.stream_url, lambda comments: handle_comments(comments, self.name), self.name)
+        self.stream.start()
+
+    def stop_stream(self):
+        if self.stream is not None:
+            self.stream.stop()
+
+    def streaming(self):
+        return self.stream is not None and self.stream.connected.is_set()
+
+# 全ての取得元のポーリングを1つのループで受け持つ
+# 取得元ごとに次のポーリング時刻を持ち、時刻が来たものだけを共有のスレッドプールで取得する。
+# 応答の遅いワンコメがあっても、ほかの取得元のポーリングは遅れない
+class SourceScheduler:
+    def __init__(self, use_stream):
+        self.use_stream = use_stream
+        self.sources = []
+        self.executor = None
+        self.workers = 0
+
+    # 取得元を設定に合わせる（設定が変わった取得元は作り直し、そのほかはポーリングの状態を引き継ぐ）
+    def update(self, source_settings):
+        current = {source.name: source for source in self.sources}
+        sources = []
+        for name, settings in source_settings.items():
+            source = current.pop(name, None)
+            if source is not None and source.settings == settings:
+                sources.append(source)
+                continue
+            if source is not None:
+                source.stop_stream()
+            source = CommentSource(name, settings)
+            if self.use_stream:
+                source.start_stream()
+            sources.append(source)
+        for source in current.values():
+            source.stop_stream()
+        self.sources = sources
+
+        # 取得元が増えたら同時に取得できる数も増やす（取得中のものは前のプールで最後まで続ける）
+        if len(sources) > self.workers:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.workers = len(sources)
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="poll")
+
+    def configure(self, interval, minimum, maximum):
+        for source in self.sources:
+            source.scheduler.configure(interval, minimum, maximum)
+
+    # 終わった取得の結果を記録し、時刻が来た取得元の取得を始めて、次に何かすることができるまで待つ
+    # 何も無くてもtimeout秒で戻る
+    def run_once(self, timeout):
+        now = time.monotonic()
+        wake = now + timeout
+        pending = []
+        for source in self.sources:
+            if source.fetching is not None:
+                if not source.fetching.done():
+                    pending.append(source.fetching)
+                    continue
+                future, source.fetching = source.fetching, None
+                source.scheduler.record(future.result())
+
+            # WebSocketでコメントを受け取れている間はポーリングしない
+            # 切断されたらすぐに1回取得して、その間に届いたコメントを取りこぼさないようにする
+            if source.streaming():
+                source.scheduler.deadline = now
+                wake = min(wake, now + POLL_INTERVAL_MIN)
+                continue
+            if source.scheduler.deadline <= now:
+                source.fetching = self.executor.submit(fetch_comments, source.api_endpoint, source.name)
+                pending.append(source.fetching)
+            else:
+                wake = min(wake, source.scheduler.deadline)
+
+        delay = max(wake - time.monotonic(), 0)
+        if pending:
+            futures.wait(pending, timeout=delay, return_when=futures.FIRST_COMPLETED)
+        elif delay > 0:
+            time.sleep(delay)
+
+    # 取得中のものを待ってから止める（止めた送信先に振り分けようとしないように）
+    def stop(self):
+        for source in self.sources:
+            source.stop_stream()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+# 設定の監視
+CONFIG_WATCH_INTERVAL = 1  # config.jsonが変わったか確かめる間隔（秒）
+# 再起動しないと反映されない設定
+RESTART_REQUIRED_KEYS = ('use_comment_stream', 'metrics_port', 'metrics_summary_interval', 'sink_isolation')
+
+# config.jsonの更新時刻と大きさを見て、変わっていれば読み込む
+class ConfigWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.signature = self.stat()
+        self.checked = time.monotonic()
+
+    def stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    # 変わっていれば読み込んだコンフィグを返す（変わっていないか、読み込めなければNone）
+    def poll(self):
+        now = time.monotonic()
+        if now - self.checked < CONFIG_WATCH_INTERVAL:
+            return None
+        self.checked = now
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            return None
+        self.signature = signature
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                new_config = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning("config.jsonを読み込めないため、今の設定のまま続けます: %s", e)
+            return None
+        if not isinstance(new_config, dict):
+            logger.warning("config.jsonの形式が正しくないため、今の設定のまま続けます。")
+            return None
+        for key, value in default_config.items():
+            new_config.setdefault(key, value)
+        return new_config
+
+# 新しいコンフィグを確かめてから入れ替える。間違いがあれば何も変えずに今の設定で続ける
+# 送信先と取得元は設定が変わったものだけを作り直し、キュー・処理済みコメント・初コメント判定は引き継ぐ
+def reload_config(new_config, scheduler):
+    global config, message_template, COMMENT_EXPIRY_DAYS, POLL_INTERVAL, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX
+    global CATCHUP_WINDOW_MINUTES, CATCHUP_AFTER_SECONDS, CATCHUP_RATE, CATCHUP_SUMMARY, SINK_PROCESS_TIMEOUT
+    global DISCORD_WEBHOOK_URL, API_ENDPOINT, MINECRAFT_RCON_HOST, MINECRAFT_RCON_PORT, MINECRAFT_RCON_PASSWORD
+    changed = sorted(key for key in set(config) | set(new_config) if config.get(key) != new_config.get(key))
+    if not changed or changed == ['api_key']:
+        config = new_config
+        return True
+    try:
+        source_settings, sink_settings, routes = load_routing(new_config)
+        intervals = polling_intervals(new_config)
+        expiry_days = float(new_config['comment_expiry_days'])
+        catchup = (float(new_config['catchup_window_minutes']), float(new_config['catchup_after_seconds']),
+                   float(new_config['catchup_rate']), bool(new_config['catchup_summary']))
+        sink_process_timeout = float(new_config['sink_process_timeout'])
+        if sink_process_timeout <= 0:
+            raise ValueError("sink_process_timeoutは0より大きくしてください。")
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        metrics.inc('commentrelay_config_reloads_total', result='rejected')
+        logger.warning("config.jsonの内容が正しくないため反映しません: %s", e)
+        return False
+
+    if (new_config['custom_format'], new_config['message_color']) != (message_template.custom_format, message_template.color):
+        message_template = MessageTemplate(new_config['custom_format'], new_config['message_color'])
+    # 振り分けの途中で経路が変わらないよう、コメントの処理と重ならないときに入れ替える
+    with comments_lock:
+        removed = update_sinks(sink_settings, routes)
+        config = new_config
+        COMMENT_EXPIRY_DAYS = expiry_days
+        POLL_INTERVAL, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX = intervals
+        CATCHUP_WINDOW_MINUTES, CATCHUP_AFTER_SECONDS, CATCHUP_RATE, CATCHUP_SUMMARY = catchup
+        catchup_pacer.rate = CATCHUP_RATE
+        SINK_PROCESS_TIMEOUT = sink_process_timeout
+        DISCORD_WEBHOOK_URL = new_config['discord_webhook_url']
+        API_ENDPOINT = new_config['api_endpoint']
+        MINECRAFT_RCON_HOST = new_config['minecraft_rcon_host']
+        MINECRAFT_RCON_PORT = new_config['minecraft_rcon_port']
+        MINECRAFT_RCON_PASSWORD = new_config['minecraft_rcon_password']
+    # 外れた送信先は溜まっている分を送り終えてから止める
+    for sink in removed:
+        logger.info("送信先「%s」を止めます。", sink.name)
+        sink.stop()
+    scheduler.update(source_settings)
+    scheduler.configure(*intervals)
+    logger.setLevel(getattr(logging, str(new_config['log_level']).upper(), logging.INFO))
+
+    restart_required = [key for key in RESTART_REQUIRED_KEYS if key in changed]
+    if restart_required:
+        logger.warning("次の設定は再起動後に反映されます: %s", ', '.join(restart_required))
+    metrics.inc('commentrelay_config_reloads_total', result='applied')
+    logger.info("config.jsonを再読み込みしました: %s", ', '.join(changed))
+    return True
+
 # コメントのポーリング
-def poll_comments():
-    if DISCORD_WEBHOOK_URL == default_config['discord_webhook_url'] or not check_discord_webhook():
-        root = tk.Tk()
-        root.withdraw()
-        messagebox.showwarning("設定エラー", "Discord Webhook URLが無効です。")
+def poll_comments(headless=False):
+    try:
+        source_settings, sink_settings, routes = load_routing(config)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        show_config_error(f"中継の経路の設定が正しくありません: {e}", headless)
         sys.exit()
 
-    while True:
-        fetch_comments(API_ENDPOINT)
-        time.sleep(POLL_INTERVAL)
+    startup = StartupChecks(sink_settings)
+    startup.start()
+    processed_comments.load_in_background()
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if METRICS_SUMMARY_INTERVAL:
+        start_metrics_summary(METRICS_SUMMARY_INTERVAL)
+
+    start_sinks(sink_settings, routes)
+
+    use_stream = USE_COMMENT_STREAM and websocket is not None
+    if USE_COMMENT_STREAM and websocket is None:
+        logger.info("websocket-clientが見つからないため、ポーリングでコメントを取得します。")
+    scheduler = SourceScheduler(use_stream)
+    scheduler.update(source_settings)
 
-def send_reward_api(user_id, live_id, is_first_time):
-    # APIエンドポイントのURL
-    url = 'https://ryuuneko.com/API/save_reward.php'
+    # 保存されたconfig.jsonは再起動せずに反映する
+    watcher = ConfigWatcher(config_path)
+    webhook_valid = True
+    try:
+        while True:
+            if not startup.poll():
+                webhook_valid = False
+                break
+            new_config = watcher.poll()
+            if new_config is not None:
+                reload_config(new_config, scheduler)
+            scheduler.run_once(min(POLL_INTERVAL, CONFIG_WATCH_INTERVAL))
+    finally:
+        scheduler.stop()
+        stop_sinks()
+        with comments_lock:
+            processed_comments.close()
+
+    if not webhook_valid:
+        if startup.invalid_webhooks == ['discord']:
+            show_config_error("Discord Webhook URLが無効です。", headless)
+        else:
+            show_config_error(f"Discord Webhook URLが無効です: {', '.join(startup.invalid_webhooks)}", headless)
+        sys.exit()
+
+# 再生
+REPLAY_BATCH_SIZE = 200  # 待たずに流すとき、1回の処理にまとめる件数（ワンコメの1回の応答と同じくらい）
+
+# --recordで記録したJSONLを読み込み、(最初のコメントからの秒数, コメント)を投稿順に並べる
+# 1行にコメントの一覧（ワンコメの応答そのもの）が入っていてもよい
+def load_recorded_comments(path):
+    comments = []
+    skipped = 0
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                for comment in entry if isinstance(entry, list) else [entry]:
+                    comments.append((datetime.fromisoformat(comment['data']['timestamp']).timestamp(), comment))
+            except (ValueError, KeyError, TypeError):
+                skipped += 1
+    if skipped:
+        logger.warning("%sの%d行は読み込めなかったため飛ばしました。", path, skipped)
+    comments.sort(key=lambda entry: entry[0])
+    first = comments[0][0] if comments else 0
+    return [(posted - first, comment) for posted, comment in comments]
+
+# 記録したコメントを本番と同じ処理（重複の除去・整形・優先度・送信キュー）で送信先に流す
+# 投稿の間隔をspeed倍速で再現し（0なら待たずに流す）、投稿時刻は流した時刻に置き換える。
+# 処理済みコメントと報酬の送信箱はメモリ上のものを使い、本番の記録を汚さず報酬も送らない
+def replay_comments(path, speed=1.0, headless=True):
+    global processed_comments, reward_outbox
+    try:
+        source_settings, sink_settings, routes = load_routing(config)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        show_config_error(f"中継の経路の設定が正しくありません: {e}", headless)
+        sys.exit()
+    source = next(iter(source_settings))
+    comments = load_recorded_comments(path)
+    logger.info("%sの%d件を%s再生します（送り先は取得元「%s」の経路）。",
+                path, len(comments), f"{speed:g}倍速で" if speed > 0 else "待たずに", source)
+
+    processed_comments = ProcessedCommentStore(':memory:')
+    processed_comments.load()
+    reward_outbox = RewardOutbox(':memory:')
+    start_sinks(sink_settings, routes)
+    started = time.monotonic()
+    index = 0
+    try:
+        while index < len(comments):
+            elapsed = (time.monotonic() - started) * speed
+            due = []
+            while index < len(comments) and (speed <= 0 or comments[index][0] <= elapsed):
+                offset, comment = comments[index]
+                data = dict(comment['data'], timestamp=datetime.now(timezone.utc).isoformat())
+                due.append(dict(comment, data=data))
+                index += 1
+                if speed <= 0 and len(due) >= REPLAY_BATCH_SIZE:
+                    break
+            if due:
+                handle_comments(due, source)
+            if speed > 0 and index < len(comments):
+                time.sleep(max(comments[index][0] / speed - (time.monotonic() - started), 0))
+        # 送信先のキューが空になるまで待ってから終わる
+        for sink in relay_sinks.values():
+            sink.worker.queue.join()
+    finally:
+        stop_sinks()
+    logger.info("%d件のコメントを%.1f秒で再生しました。", len(comments), time.monotonic() - started)
+
+# 報酬APIのURL
+REWARD_API_URL = 'https://ryuuneko.com/API/save_reward.php'
+
+def send_reward_api(user_id, live_id, is_first_time, session=requests):
     # 送信するデータ
     data = {
-    'user_id': 'yt-UCnWzPMHQV996JEC6QDH3-Qg',        # ユーザーID
-    'live_id': 'rMd2BoUQb7c',                        # ライブID
+    'user_id': user_id,                               # ユーザーID
+    'live_id': live_id,                               # ライブID
     'received_flag': '0',                             # 受取済みフラグ（1: 受け取った、0: 受け取っていない）
     'api_key': api_key    # APIキー（適切なAPIキーに置き換え）
     }
 
-    
-    try:
-        # POSTリクエストを送信
-        # POSTリクエストの送信
-        response = requests.post(url, data=data)
-        
-        # サーバー側のレスポンスコードを表示
-        print(f"Status Code: {response.status_code}")
-        
-        # サーバーからのレスポンス内容を表示（成功した場合）
-        if response.status_code == 200:
-            print(f"Response: {response.text}")
-        else:
-            print(f"Error: {response.text}")
-    
-    except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
+    # POSTリクエストの送信（例外は呼び出し側で扱う）
+    response = session.post(REWARD_API_URL, data=data, timeout=HTTP_TIMEOUT)
+
+    # サーバー側のレスポンスコードを表示
+    logger.debug("Status Code: %s", response.status_code)
+
+    # サーバーからのレスポンス内容を表示（成功した場合）
+    if response.status_code == 200:
+        logger.debug("Response: %s", response.text)
+    else:
+        logger.warning("Error: %s", response.text)
+    return response.status_code
+
+# 報酬送信の設定
+reward_outbox_db = 'reward_outbox.db'
+REWARD_BATCH_SIZE = 20          # 1回にまとめて送る件数
+REWARD_RETRY_BASE_DELAY = 1     # 送信失敗時の待ち時間の初期値（秒）
+REWARD_RETRY_MAX_DELAY = 300    # 送信失敗時の待ち時間の上限（秒）
+
+# 報酬の送信待ちを溜めておく送信箱
+# 初コメントの報酬はまずSQLiteに書き込み、別スレッドがまとめて送信する。
+# 成功の応答(200)を受け取ってから消すので、送信先が落ちていても再起動しても報酬は失われない。
+# 4xxで拒否されたものは送り直しても通らないのでfailedとして残し、再送しない
+class RewardOutbox:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.session = requests.Session()
+        self.retry_base_delay = REWARD_RETRY_BASE_DELAY
+        self.retry_max_delay = REWARD_RETRY_MAX_DELAY
+        self.failures = 0
+        self.thread = None
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS reward_outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, live_id TEXT NOT NULL, '
+            'created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0)'
+        )
+        self.conn.commit()
+
+    def put(self, user_id, live_id):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT INTO reward_outbox (user_id, live_id, created) VALUES (?, ?, ?)',
+                              (user_id, live_id, time.time()))
+        self.wakeup.set()
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM reward_outbox WHERE failed = 0').fetchone()[0]
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="reward-outbox", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # APIキーが分かるまで取得し直す（起動時にキーのサーバーに届かなくても、その回の報酬を諦めない）
+    # 止められたらFalseを返す
+    def wait_for_api_key(self):
+        global api_key
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                key = ensure_api_key()
+            except (requests.exceptions.RequestException, OSError, ValueError) as e:
+                logger.warning("APIキーの確認でエラーが発生しました: %s", e)
+                key = None
+            if key:
+                api_key = key
+                logger.info("使用するAPIキー: %s", api_key)
+                return True
+            failures += 1
+            delay = min(self.retry_base_delay * (2 ** (failures - 1)), self.retry_max_delay)
+            logger.warning("APIキーの取得に失敗しました。%.1f秒後にやり直します。", delay)
+            metrics.inc('commentrelay_retries_total', sink='reward')
+            self.stopped.wait(delay)
+        return False
+
+    def run(self):
+        if not api_key and not self.wait_for_api_key():
+            return
+        while not self.stopped.is_set():
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT id, user_id, live_id FROM reward_outbox WHERE failed = 0 ORDER BY id LIMIT ?',
+                    (REWARD_BATCH_SIZE,)).fetchall()
+            if not rows:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            if self.send_batch(rows):
+                self.failures = 0
+                continue
+
+            # 失敗が続くほど間隔を延ばして送り直す
+            self.failures += 1
+            delay = min(self.retry_base_delay * (2 ** (self.failures - 1)), self.retry_max_delay)
+            logger.warning("報酬APIへの送信に失敗しました。%.1f秒後に再送します（未送信%d件以上）", delay, len(rows))
+            metrics.inc('commentrelay_retries_total', sink='reward')
+            self.stopped.wait(delay)
+
+    # 先頭から順に送り、受け付けられた分だけ消す。途中で失敗したら残りは次回に回す
+    def send_batch(self, rows):
+        done = []
+        rejected = []
+        ok = True
+        for row_id, user_id, live_id in rows:
+            try:
+                start = time.perf_counter()
+                status = send_reward_api(user_id, live_id, True, session=self.session)
+                metrics.observe('commentrelay_sink_send_seconds', time.perf_counter() - start, sink='reward')
+            except requests.exceptions.RequestException as e:
+                logger.warning("Request failed: %s", e)
+                ok = False
+                break
+            if status == 200:
+                done.append((row_id,))
+            elif 400 <= status < 500 and status != 429:
+                rejected.append((row_id,))
+            else:
+                ok = False
+                break
+
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM reward_outbox WHERE id = ?', done)
+            self.conn.executemany('UPDATE reward_outbox SET failed = 1 WHERE id = ?', rejected)
+            if not ok:
+                self.conn.execute('UPDATE reward_outbox SET attempts = attempts + 1 WHERE id = ?', (rows[len(done) + len(rejected)][0],))
+        return ok
+
+reward_outbox = RewardOutbox(':memory:' if IS_SINK_PROCESS else reward_outbox_db)
+metrics.gauge('commentrelay_reward_outbox_pending', reward_outbox.pending)
 
 
 API_URL = 'https://ryuuneko.com/API/api.php'
@@ -304,7 +2234,7 @@ def load_api_key():
 
 # APIキーを生成する関数
 def generate_api_key():
-    response = requests.get(API_URL)
+    response = requests.get(API_URL, timeout=HTTP_TIMEOUT)
     
     if response.status_code == 200:
         data = response.json()
@@ -313,10 +2243,10 @@ def generate_api_key():
         if 'api_key' in data:
             return data['api_key']
         else:
-            print("APIからAPIキーを取得できませんでした。")
+            logger.error("APIからAPIキーを取得できませんでした。")
             return None
     else:
-        print(f"APIのリクエストに失敗しました: {response.status_code}")
+        logger.error("APIのリクエストに失敗しました: %s", response.status_code)
         return None
 
 # コンフィグにAPIキーが無い場合に新たにAPIキーを生成
@@ -324,29 +2254,44 @@ def ensure_api_key():
     api_key = load_api_key()
     
     if not api_key:
-        print("APIキーが見つかりません。新しいAPIキーを生成します...")
+        logger.info("APIキーが見つかりません。新しいAPIキーを生成します...")
         api_key = generate_api_key()
         
         if api_key:
-            print(f"新しいAPIキーを取得しました: {api_key}")
+            logger.info("新しいAPIキーを取得しました: %s", api_key)
             
             # コンフィグファイルにAPIキーを保存
-            with open(config_path, 'r+', encoding='utf-8') as file:
+            # 設定の監視が書きかけのファイルを読まないよう、置き換えで保存する
+            with open(config_path, 'r', encoding='utf-8') as file:
                 config = json.load(file)
-                config['api_key'] = api_key
-                file.seek(0)
-                json.dump(config, file, ensure_ascii=False, indent=4)
+            config['api_key'] = api_key
+            write_json_atomic(config_path, config)
                 
     return api_key
 
-# APIキーを確認して取得
-api_key = ensure_api_key()
+# APIキー（報酬の送信箱のスレッドが送り始める前に確認して設定する）
+api_key = None
 
-if api_key:
-    print(f"使用するAPIキー: {api_key}")
-else:
-    print("APIキーの取得に失敗しました。")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ワンコメのコメントをMinecraftとDiscordに中継します。")
+    parser.add_argument('--headless', action='store_true', help="GUIを使わずに動かす（設定エラーはログにだけ出す）")
+    parser.add_argument('--record', metavar='FILE', help="新しく届いたコメントをJSONLで追記する（--replayで再生できる）")
+    parser.add_argument('--replay', metavar='FILE', help="記録したコメント（JSONL）を送信先に流して終了する")
+    parser.add_argument('--speed', type=float, default=1.0, help="--replayの再生速度（2なら2倍速、0なら待たずに流す）")
+    args = parser.parse_args(argv)
+    if args.replay:
+        replay_comments(args.replay, speed=args.speed, headless=args.headless)
+        return
+
+    global comment_recorder
+    if args.record:
+        comment_recorder = CommentRecorder(args.record)
+    try:
+        poll_comments(headless=args.headless)
+    finally:
+        if comment_recorder is not None:
+            comment_recorder.close()
 
 # メイン
 if __name__ == "__main__":
-    poll_comments()
+    main()
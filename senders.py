@@ -0,0 +1,517 @@
+# CommentRelayの送信の部品（Discord Webhook・Minecraft RCON・計測値）
+# 送信先ごとのプロセス（sink_isolation: "process"）はこのモジュールのrun_sink_processを動かす。
+# 子プロセスで読み込まれても設定ファイルやDBに触れないよう、読み込んだだけでは何も起こさないようにしておく
+import json
+import requests
+import time
+import struct
+import select
+import socket
+import threading
+import logging
+import functools
+
+# HTTPリクエストのタイムアウト（秒）。応答しない相手で送信スレッドが止まり続けないようにする
+HTTP_TIMEOUT = 10
+
+logger = logging.getLogger('commentrelay')
+
+# 計測値
+# 処理の各段階の時間・キューの長さ・再試行や破棄の回数などを集め、
+# Prometheusのテキスト形式か1行の要約で出力する
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (名前, ラベル) -> 値
+        self.histograms = {}  # (名前, ラベル) -> [バケットごとの件数..., 合計, 件数]
+        self.gauges = {}      # (名前, ラベル) -> 値を返す関数
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def gauge(self, name, function, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = function
+
+    def counter_value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def gauge_values(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = []
+        for key, function in gauges:
+            try:
+                values.append((key, function()))
+            except Exception:
+                continue
+        return values
+
+    def render(self):
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+        for (name, labels), value in sorted(self.gauge_values()):
+            declare(name, 'gauge')
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            declare(name, 'histogram')
+            for bound, count in zip(METRICS_BUCKETS, histogram):
+                lines.append(f'{name}_bucket{self.format_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{self.format_labels(labels, [("le", "+Inf")])} {histogram[-1]}')
+            lines.append(f'{name}_sum{self.format_labels(labels)} {histogram[-2]}')
+            lines.append(f'{name}_count{self.format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    # ヘッドレスで動かすとき用の1行の要約（カウンターと平均時間とゲージ）
+    def summary(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        parts = []
+        for (name, labels), value in counters:
+            parts.append(f'{self.short_name(name, labels)}={value}')
+        for (name, labels), value in sorted(self.gauge_values()):
+            parts.append(f'{self.short_name(name, labels)}={value}')
+        for (name, labels), histogram in histograms:
+            if histogram[-1]:
+                parts.append(f'{self.short_name(name, labels)}_avg={histogram[-2] / histogram[-1] * 1000:.1f}ms')
+        return ' '.join(parts)
+
+    @staticmethod
+    def short_name(name, labels):
+        name = name.replace('commentrelay_', '')
+        return '.'.join([name] + [str(value) for _, value in labels])
+
+metrics = Metrics()
+
+# Discord Webhookの制限
+DISCORD_MAX_EMBEDS = 10              # 1メッセージに付けられる埋め込みの数
+DISCORD_MAX_EMBED_TOTAL = 6000       # 1メッセージ内の埋め込みの合計文字数
+DISCORD_MAX_DESCRIPTION = 4096       # 埋め込み1つの本文の文字数
+DISCORD_MAX_AUTHOR_NAME = 256        # 埋め込みの投稿者名の文字数
+DISCORD_MAX_CONTENT = 2000           # 通常メッセージの本文の文字数
+DISCORD_MAX_RETRIES = 5              # 1回の送信で再試行する回数
+DISCORD_RETRY_BASE_DELAY = 1         # 429以外のエラーで再試行するときの待ち時間の初期値（秒）
+
+# レート制限を守りながらWebhookに送信するクラス
+# 接続はSessionで使い回し、X-RateLimit-*ヘッダーから残り回数を追跡する
+# 制限で待たされている間に溜まったコメントは埋め込みにまとめて1回で送る
+class DiscordSender:
+    def __init__(self, webhook_url):
+        self.webhook_url = webhook_url
+        self.session = requests.Session()
+        self.session.headers['Content-Type'] = 'application/json'
+        self.remaining = None
+        self.reset_at = 0.0
+        self.rate_limited = 0
+        self.congested = False  # 制限を使い切りそう（残り1回以下）か、429を受け取った後
+        self.progress = None    # 送信プロセスのとき、時間のかかる処理の前にその長さ（秒）を親プロセスへ知らせる関数
+
+    # これから最長seconds秒かかる処理をすることを知らせる（送信プロセスでなければ何もしない）
+    def report(self, seconds):
+        if self.progress is not None:
+            self.progress(seconds)
+
+    # 制限の残りが0ならリセットまで待つ
+    def wait_for_bucket(self):
+        if self.remaining == 0:
+            delay = self.reset_at - time.monotonic()
+            if delay > 0:
+                self.report(delay)
+                time.sleep(delay)
+            self.remaining = None
+
+    def update_bucket(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset_after = response.headers.get('X-RateLimit-Reset-After')
+        if remaining is not None:
+            self.remaining = int(remaining)
+            self.congested = self.remaining <= 1
+        if reset_after is not None:
+            self.reset_at = time.monotonic() + float(reset_after)
+
+    # コメント1件なら従来どおり本人の名前とアイコンで、複数件なら埋め込みにまとめたペイロードを作る
+    @staticmethod
+    def build_payloads(messages):
+        if len(messages) == 1:
+            display_name, text, avatar_url = messages[0]
+            return [{
+                'username': display_name,
+                'content': text[:DISCORD_MAX_CONTENT],
+                'avatar_url': avatar_url  # アイコンを追加
+            }]
+
+        payloads = []
+        embeds = []
+        total = 0
+        for display_name, text, avatar_url in messages:
+            name = display_name[:DISCORD_MAX_AUTHOR_NAME]
+            description = text[:DISCORD_MAX_DESCRIPTION]
+            size = len(name) + len(description)
+            if embeds and (len(embeds) >= DISCORD_MAX_EMBEDS or total + size > DISCORD_MAX_EMBED_TOTAL):
+                payloads.append({'embeds': embeds})
+                embeds = []
+                total = 0
+            embeds.append({'author': {'name': name, 'icon_url': avatar_url}, 'description': description})
+            total += size
+        if embeds:
+            payloads.append({'embeds': embeds})
+        return payloads
+
+    def backoff(self, attempt):
+        delay = DISCORD_RETRY_BASE_DELAY * (2 ** attempt)
+        self.report(delay)
+        time.sleep(delay)
+
+    def post(self, payload):
+        for attempt in range(DISCORD_MAX_RETRIES + 1):
+            self.wait_for_bucket()
+            try:
+                self.report(HTTP_TIMEOUT)
+                response = self.session.post(self.webhook_url, json=payload, timeout=HTTP_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                logger.warning("Discordへのコメント送信でエラーが発生しました: %s", e)
+                metrics.inc('commentrelay_retries_total', sink='discord')
+                self.backoff(attempt)
+                continue
+
+            self.update_bucket(response)
+            if response.status_code == 429:
+                # サーバーが指定した時間だけ待ってから同じ内容を送り直す
+                self.rate_limited += 1
+                metrics.inc('commentrelay_rate_limited_total', sink='discord')
+                try:
+                    retry_after = float(response.json().get('retry_after', 1))
+                except ValueError:
+                    retry_after = float(response.headers.get('Retry-After', 1))
+                self.remaining = 0
+                self.reset_at = time.monotonic() + retry_after
+                self.congested = True
+                continue
+            if response.status_code >= 500:
+                logger.warning("Discordへのコメント送信でエラーが発生しました: %s", response.status_code)
+                metrics.inc('commentrelay_retries_total', sink='discord')
+                self.backoff(attempt)
+                continue
+            if response.status_code >= 400:
+                # 内容そのものが拒否された場合は送り直しても通らないので諦める
+                logger.warning("Discordへのコメント送信でエラーが発生しました: %s", response.status_code)
+                logger.warning("エラーレスポンス: %s", response.text)  # エラーレスポンスを表示
+                return False
+            return True
+
+        logger.error("Discordへの送信を%d回再試行しましたが失敗しました。", DISCORD_MAX_RETRIES)
+        return False
+
+    # 1回に送るコメント数の上限。制限に余裕があるうちは1件ずつ（本人の名前とアイコンで）送り、
+    # コメントが制限より速く届いて使い切りそうなときだけ埋め込みにまとめる
+    def batch_limit(self):
+        return DISCORD_MAX_EMBEDS if self.congested else 1
+
+    def send(self, messages):
+        for payload in self.build_payloads(messages):
+            logger.debug("送信するペイロード: %s", payload)  # 送信前にペイロードを表示
+            if self.post(payload):
+                logger.debug("Discordにコメントを送信しました: %d件", len(payload.get('embeds', [payload])))
+
+# RCON接続の設定
+RCON_TIMEOUT = 5                  # 1回のやり取り（送信から応答を受け取り終えるまで）の上限（秒）
+RCON_RECONNECT_BASE_DELAY = 0.5   # 再接続バックオフの初期値（秒）
+RCON_RECONNECT_MAX_DELAY = 30     # 再接続バックオフの上限（秒）
+RCON_HEALTH_CHECK_INTERVAL = 30   # この秒数以上使っていない接続は使う前に生存確認する
+RCON_MAX_PACKET_BYTES = 64 * 1024 # これより長いと名乗るパケットは壊れているものとして扱う
+# 1回のコマンドにかかりうる最長の時間（接続・ログイン・送信をそれぞれRCON_TIMEOUTまで、再接続して2回）
+RCON_COMMAND_MAX_SECONDS = 6 * RCON_TIMEOUT
+
+# RCONのパケットの種類
+RCON_LOGIN = 3
+RCON_COMMAND = 2
+RCON_AUTH_RESPONSE = 2
+
+# 1台のMinecraftサーバーへの認証済みRCON接続
+# コメントごとに接続・ログインし直すのではなく、1本の接続を使い回す。
+# パケットの読み書きはソケットのタイムアウトだけで行い、シグナル（SIGALRM）は使わない
+# （送信スレッドから呼ばれても、タイムアウトがメインスレッドで起きてリレー全体が止まることがない）
+class RconConnection:
+    def __init__(self, host, port, password, timeout=RCON_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.socket = None
+        self.request_id = 0
+        self.lock = threading.Lock()
+        self.last_used = 0.0
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def is_connected(self):
+        return self.socket is not None
+
+    def connect(self):
+        now = time.monotonic()
+        if now < self.next_attempt:
+            raise ConnectionError(f"RCON再接続の待機中です（あと{self.next_attempt - now:.1f}秒）")
+        try:
+            # ログインの応答を待つ間もタイムアウトが効くよう、接続した時点でタイムアウトを設定しておく
+            self.socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.request(RCON_LOGIN, self.password)
+        except Exception:
+            self.disconnect()
+            # 失敗が続くほど次の接続試行までの間隔を延ばす
+            self.failures += 1
+            delay = min(RCON_RECONNECT_BASE_DELAY * (2 ** (self.failures - 1)), RCON_RECONNECT_MAX_DELAY)
+            self.next_attempt = now + delay
+            raise
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.last_used = now
+        logger.info("RCONに接続しました: %s:%s", self.host, self.port)
+
+    def disconnect(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            self.socket = None
+
+    # deadlineまでにlengthバイトを受け取る。相手が接続を閉じたらConnectionError
+    def recv_exact(self, length, deadline):
+        data = b''
+        while len(data) < length:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("RCONの応答がタイムアウトしました")
+            self.socket.settimeout(remaining)
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("RCONの接続がサーバー側で閉じられました")
+            data += chunk
+        return data
+
+    def read_packet(self, deadline):
+        (length,) = struct.unpack('<i', self.recv_exact(4, deadline))
+        if not 10 <= length <= RCON_MAX_PACKET_BYTES:
+            raise ConnectionError(f"RCONの応答の長さが不正です: {length}")
+        body = self.recv_exact(length, deadline)
+        request_id, packet_type = struct.unpack('<ii', body[:8])
+        return request_id, packet_type, body[8:-2].decode('utf-8', 'replace')
+
+    # パケットを1つ送り、その応答の本文を返す。応答を受け取り終えるまで全体でtimeout秒まで待つ
+    def request(self, packet_type, payload):
+        self.request_id = self.request_id % 0x7fffffff + 1
+        body = struct.pack('<ii', self.request_id, packet_type) + payload.encode('utf-8') + b'\x00\x00'
+        deadline = time.monotonic() + self.timeout
+        self.socket.settimeout(self.timeout)
+        self.socket.sendall(struct.pack('<i', len(body)) + body)
+        while True:
+            request_id, response_type, text = self.read_packet(deadline)
+            if packet_type == RCON_LOGIN:
+                # サーバーによってはログインの応答の前に空の応答を返すので読み飛ばす
+                if response_type != RCON_AUTH_RESPONSE:
+                    continue
+                if request_id == -1:
+                    raise ConnectionError("RCONのログインに失敗しました（パスワードを確認してください）")
+                return text
+            # 前にタイムアウトしたコマンドの応答が遅れて届いた場合は読み捨てる
+            if request_id == self.request_id:
+                return text
+
+    # 相手側に切断されていないかを確認する（データを読み捨てずに覗くだけ）
+    def health_check(self):
+        if not self.is_connected():
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+            if readable:
+                # 読めるのに0バイトならサーバー側が接続を閉じている
+                if not self.socket.recv(1, socket.MSG_PEEK):
+                    return False
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def command(self, command):
+        with self.lock:
+            if self.is_connected() and time.monotonic() - self.last_used > RCON_HEALTH_CHECK_INTERVAL:
+                if not self.health_check():
+                    logger.info("RCON接続が切れていたため再接続します: %s:%s", self.host, self.port)
+                    self.disconnect()
+
+            # 送信中に接続が切れた場合は1回だけ再接続してやり直す
+            for attempt in range(2):
+                if not self.is_connected():
+                    self.connect()
+                try:
+                    response = self.request(RCON_COMMAND, command)
+                    self.last_used = time.monotonic()
+                    return response
+                except (OSError, struct.error) as e:
+                    self.disconnect()
+                    if attempt == 1:
+                        raise
+                    logger.warning("RCONの送信に失敗したため再接続します: %s", e)
+                    metrics.inc('commentrelay_retries_total', sink='minecraft')
+
+# サーバーごとに1本ずつRCON接続を保持するプール
+class RconPool:
+    def __init__(self, timeout=RCON_TIMEOUT):
+        self.timeout = timeout
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, password):
+        key = (host, port, password)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None:
+                connection = RconConnection(host, port, password, timeout=self.timeout)
+                self.connections[key] = connection
+            return connection
+
+    def command(self, host, port, password, command):
+        return self.get(host, port, password).command(command)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.disconnect()
+            self.connections.clear()
+
+rcon_pool = RconPool()
+
+# RCONで送れるコマンドの長さの上限（Minecraftが受け付けるパケットの本文は1446バイトまで）
+RCON_MAX_COMMAND_BYTES = 1446
+
+def tellraw_command(components):
+    # 先頭の空文字はテキスト成分の親になり、後ろの成分にスタイルを引き継がせないためのもの
+    return 'tellraw @a ' + json.dumps([""] + components, ensure_ascii=False, separators=(',', ':'))
+
+def command_bytes(components):
+    return len(tellraw_command(components).encode('utf-8'))
+
+# 複数のコメントを1行ずつ並べたtellrawコマンドにまとめる
+# JSONはエンコーダーで作るので、引用符やバックスラッシュを含むコメントでも壊れない。
+# RCONの上限を超える分は次のコマンドに回し、1件だけで超える場合は本文を切り詰める
+def build_tellraw_commands(messages):
+    commands = []
+    components = []
+    for message in messages:
+        candidate = components + ([{"text": "\n"}] if components else []) + [message]
+        if command_bytes(candidate) <= RCON_MAX_COMMAND_BYTES:
+            components = candidate
+            continue
+        if components:
+            commands.append(tellraw_command(components))
+        components = [message]
+        while command_bytes(components) > RCON_MAX_COMMAND_BYTES:
+            # はみ出したバイト数を目安に切り詰める（日本語は1文字3バイト）
+            excess = command_bytes(components) - RCON_MAX_COMMAND_BYTES
+            text = message['text'][:max(len(message['text']) - max(excess // 3, 1) - 1, 0)] + '…'
+            message = dict(message, text=text)
+            components = [message]
+    if components:
+        commands.append(tellraw_command(components))
+    return commands
+
+# 送信スレッドから呼ばれる。その時点でキューに溜まっていたコメント（minecraft_messageの形）をまとめて送る
+# serverは(ホスト, ポート, パスワード)で、送信先の設定（routing）から渡す。
+# progressを渡すと、コマンドを1つ送るたびにかかりうる最長の時間（秒）を知らせる（送信プロセス用）
+def send_minecraft_batch(messages, server, progress=None):
+    host, port, password = server
+    try:
+        for command in build_tellraw_commands(messages):
+            logger.debug("tellrawコマンドを実行中: %s", command)
+
+            # RCONを使ってコマンドを送信（接続はプールで使い回す）
+            if progress is not None:
+                progress(RCON_COMMAND_MAX_SECONDS)
+            response = rcon_pool.command(host, port, password, command)
+            logger.debug("RCONのレスポンス: %s", response)
+        if messages:
+            logger.debug("Minecraftに送信しました: %d件", len(messages))
+    except Exception as e:
+        logger.error("Minecraftへの送信でエラーが発生しました: %s", e)
+
+# 送信プロセスのログは、親プロセスと同じ形式でコンソールに直接書く
+def setup_sink_process_logging(level):
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%H:%M:%S'))
+    logger.addHandler(console)
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+
+# 送信先ごとの送信プロセス（sink_isolationがprocessのとき）で動く。
+# (番号, コメントのリスト)を受け取って送り、送り終えたら('done', 番号, 次に送れるまでの秒数, 制限を使い切りそうか)を返す。
+# 送っている間は、HTTPの送信・再試行の待ち・RCONのコマンドの前ごとに('progress', その処理にかかりうる最長の秒数)を送る
+# （親プロセスはこれを受け取るたびに待ち時間を延ばすので、再試行で待っているだけの送信プロセスを作り直さずに済む）
+# Noneを受け取るか、親プロセスがいなくなったら終わる
+def run_sink_process(conn, sink_type, settings, log_level):
+    setup_sink_process_logging(log_level)
+
+    def progress(seconds):
+        conn.send(('progress', seconds))
+
+    sender = None
+    if sink_type == 'discord':
+        sender = DiscordSender(settings['webhook_url'])
+        sender.progress = progress
+        send = sender.send
+    else:
+        server = (settings['host'], settings['port'], settings['password'])
+        send = functools.partial(send_minecraft_batch, server=server, progress=progress)
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+            sequence, messages = request
+            try:
+                send(messages)
+            except Exception as e:
+                logger.error("%sへの送信でエラーが発生しました: %s", settings['name'], e)
+            # レート制限の残りが0なら、解除までの時間を伝えて親プロセス側で待ってもらう
+            # （待っている間に溜まったコメントを次のまとまりに入れられる）
+            pause = sender.reset_at - time.monotonic() if sender is not None and sender.remaining == 0 else 0
+            conn.send(('done', sequence, pause, sender is not None and sender.congested))
+    finally:
+        rcon_pool.close()
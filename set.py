@@ -2,6 +2,8 @@ import tkinter as tk
 from tkinter import messagebox, colorchooser
 import json
 import os
+import tempfile
+import time
 
 # 設定ファイルのパス
 CONFIG_FILE_PATH = "config.json"
@@ -11,6 +13,8 @@ DEFAULT_CONFIG = {
     'discord_webhook_url': 'https://discord.com/api/webhooks/your_webhook_url_here',
     'api_endpoint': 'http://localhost:11180/api/comments',
     'polling_interval': 1,
+    'polling_interval_min': 0.25,
+    'polling_interval_max': 5,
     'comment_expiry_days': 1,
     'minecraft_rcon_host': 'localhost',
     'minecraft_rcon_port': 25575,
@@ -37,13 +41,34 @@ def load_config():
         return DEFAULT_CONFIG
 
 # 設定ファイルの保存
+# 動いているCommentRelayが保存を見て設定を読み直すので、一時ファイルに書いてから置き換え、
+# 書きかけのファイルを読まれないようにする
 def save_config(config):
+    temp_path = None
     try:
-        with open(CONFIG_FILE_PATH, 'w', encoding='utf-8') as file:
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(CONFIG_FILE_PATH) + '.', suffix='.tmp',
+                                         dir=os.path.dirname(os.path.abspath(CONFIG_FILE_PATH)))
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
             json.dump(config, file, ensure_ascii=False, indent=4)
+        # CommentRelayが読み込んでいる一瞬は置き換えに失敗することがあるので少し待ってやり直す
+        for attempt in range(5):
+            try:
+                os.replace(temp_path, CONFIG_FILE_PATH)
+                break
+            except PermissionError:
+                if attempt == 4:
+                    raise
+                time.sleep(0.05)
+        temp_path = None
         print("設定が保存されました。")
     except Exception as e:
         print(f"設定の保存中にエラーが発生しました: {e}")
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
 
 # GUIの構築
 class ConfigApp:
@@ -83,25 +108,38 @@ class ConfigApp:
         self.api_entry.grid(row=1, column=1, pady=5)
 
         # Polling Interval
-        self.polling_label = tk.Label(self.left_frame, text="Polling Interval (秒):")
+        self.polling_label = tk.Label(self.left_frame, text="Polling Interval 目標 (秒):")
         self.polling_label.grid(row=2, column=0, sticky='w', pady=5)
         self.polling_entry = tk.Entry(self.left_frame, width=50)
         self.polling_entry.insert(0, self.config['polling_interval'])
         self.polling_entry.grid(row=2, column=1, pady=5)
 
+        # Polling Interval（コメントの量に合わせて最小〜最大の間で自動調整される）
+        self.polling_min_label = tk.Label(self.left_frame, text="Polling Interval 最小 (秒):")
+        self.polling_min_label.grid(row=3, column=0, sticky='w', pady=5)
+        self.polling_min_entry = tk.Entry(self.left_frame, width=50)
+        self.polling_min_entry.insert(0, self.config.get('polling_interval_min', DEFAULT_CONFIG['polling_interval_min']))
+        self.polling_min_entry.grid(row=3, column=1, pady=5)
+
+        self.polling_max_label = tk.Label(self.left_frame, text="Polling Interval 最大 (秒):")
+        self.polling_max_label.grid(row=4, column=0, sticky='w', pady=5)
+        self.polling_max_entry = tk.Entry(self.left_frame, width=50)
+        self.polling_max_entry.insert(0, self.config.get('polling_interval_max', DEFAULT_CONFIG['polling_interval_max']))
+        self.polling_max_entry.grid(row=4, column=1, pady=5)
+
         # Comment Expiry Days
         self.expiry_label = tk.Label(self.left_frame, text="Comment Expiry Days:")
-        self.expiry_label.grid(row=3, column=0, sticky='w', pady=5)
+        self.expiry_label.grid(row=5, column=0, sticky='w', pady=5)
         self.expiry_entry = tk.Entry(self.left_frame, width=50)
         self.expiry_entry.insert(0, self.config['comment_expiry_days'])
-        self.expiry_entry.grid(row=3, column=1, pady=5)
+        self.expiry_entry.grid(row=5, column=1, pady=5)
 
         # Minecraft RCON Host
         self.rcon_host_label = tk.Label(self.left_frame, text="Minecraft RCON Host:")
-        self.rcon_host_label.grid(row=4, column=0, sticky='w', pady=5)
+        self.rcon_host_label.grid(row=6, column=0, sticky='w', pady=5)
         self.rcon_host_entry = tk.Entry(self.left_frame, width=50)
         self.rcon_host_entry.insert(0, self.config['minecraft_rcon_host'])
-        self.rcon_host_entry.grid(row=4, column=1, pady=5)
+        self.rcon_host_entry.grid(row=6, column=1, pady=5)
 
         # Minecraft RCON Port
         self.rcon_port_label = tk.Label(self.right_frame, text="Minecraft RCON Port:")
@@ -147,10 +185,24 @@ class ConfigApp:
             self.color_display.config(bg=color_code, text=f"現在の色: {color_code}")  # 色選択結果を表示
 
     def save_settings(self):
+        # ポーリング間隔は小数も使える（最小 <= 目標 <= 最大）
+        try:
+            polling_interval = float(self.polling_entry.get())
+            polling_interval_min = float(self.polling_min_entry.get())
+            polling_interval_max = float(self.polling_max_entry.get())
+        except ValueError:
+            messagebox.showerror("入力エラー", "Polling Intervalには数値を入力してください。")
+            return
+        if not 0 < polling_interval_min <= polling_interval <= polling_interval_max:
+            messagebox.showerror("入力エラー", "Polling Intervalは 0 < 最小 <= 目標 <= 最大 になるように入力してください。")
+            return
+
         # 設定を保存
         self.config['discord_webhook_url'] = self.webhook_entry.get()
         self.config['api_endpoint'] = self.api_entry.get()
-        self.config['polling_interval'] = int(self.polling_entry.get())
+        self.config['polling_interval'] = polling_interval
+        self.config['polling_interval_min'] = polling_interval_min
+        self.config['polling_interval_max'] = polling_interval_max
         self.config['comment_expiry_days'] = int(self.expiry_entry.get())
         self.config['minecraft_rcon_host'] = self.rcon_host_entry.get()
         self.config['minecraft_rcon_port'] = int(self.rcon_port_entry.get())
@@ -158,7 +210,7 @@ class ConfigApp:
         self.config['custom_format'] = self.format_entry.get()
 
         save_config(self.config)
-        messagebox.showinfo("保存完了", "設定が保存されました！")
+        messagebox.showinfo("保存完了", "設定が保存されました！起動中のCommentRelayにもそのまま反映されます。")
 
 # メイン処理
 if __name__ == "__main__":